@@ -3,18 +3,30 @@
 и персонализированными советами.
 """
 
-from typing import Dict, List, Any, Optional
-from datetime import datetime
+import asyncio
+from typing import Dict, Generator, List, Any, Optional
+from datetime import datetime, timedelta
 
-from core.ai.query_analyzer import analyze_query
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.utils import timezone
+
+from core.ai.query_analyzer import QueryAnalysis, analyze_query
 from core.ai.context_builder import build_enriched_context
-from core.llm import chat_with_context
-from core.models import ChatSession, ChatMessage
+from core.ai.response_cache import (
+    CACHEABLE_QUERY_TYPES,
+    get_cached_response,
+    store_response,
+)
+from core.llm import chat_with_context, stream_chat_with_context
+from core.models import ChatSession, ChatMessage, QuickInsightCache
 from django.conf import settings
 
 
-# Улучшенный системный промпт для финансового советчика
-ADVANCED_FINANCIAL_PROMPT = """
+# Улучшенный системный промпт для финансового советчика.
+# Статическая часть не меняется между запросами и отправляется отдельным
+# блоком, чтобы провайдер мог закэшировать её как префикс.
+STATIC_SYSTEM_PROMPT = """
 **CRITICAL: You MUST respond ONLY in English. Never use Russian or any other language in your responses.**
 
 You are a **Personal Financial Analyst and Advisor** of the highest level.
@@ -128,7 +140,10 @@ THEN:
 - IGNORE ALL FORMATTING RULES (section 4).
 - Reply ONLY: "This message has nothing to do with our financial project."
 - DO NOT generate any headers or financial advice.
----
+"""
+
+# Динамическая часть с контекстом пользователя (идёт последним блоком)
+CONTEXT_WRAPPER = """---
 
 # USER CONTEXT
 
@@ -141,6 +156,30 @@ Based on the context above and the user's question, provide the most useful, ins
 Remember: your goal is to genuinely improve the user's financial well-being, not just answer the question.
 """
 
+# Полный промпт одной строкой (для обратной совместимости)
+ADVANCED_FINANCIAL_PROMPT = STATIC_SYSTEM_PROMPT + CONTEXT_WRAPPER
+
+# Единственный плейсхолдер — делим шаблон заранее и подставляем конкатенацией
+_CONTEXT_PREFIX, _CONTEXT_SUFFIX = CONTEXT_WRAPPER.split("{enriched_context}")
+
+
+# Запрос для быстрых инсайтов на дашборде "Что нового?"
+QUICK_INSIGHTS_QUERY = "Give a brief analysis of my financial situation and give 2-3 most important tips right now."
+
+# Сколько живут предрассчитанные инсайты (обновляются командой refresh_quick_insights)
+QUICK_INSIGHTS_MAX_AGE = timedelta(days=1)
+
+
+def _db_call(func):
+    """
+    Оборачивает синхронную функцию (ORM, HTTP) для запуска в пуле потоков,
+    чтобы независимые вызовы могли выполняться параллельно.
+    """
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        return func(*args, **kwargs)
+    return sync_to_async(wrapper, thread_sensitive=False)
+
 
 class EnhancedFinancialAdvisor:
     """
@@ -156,7 +195,8 @@ class EnhancedFinancialAdvisor:
         self, 
         user_query: str,
         use_local: bool = False,
-        anonymize: bool = True
+        anonymize: bool = True,
+        use_cache: Optional[bool] = None
     ) -> Dict[str, Any]:
         """
         Получает персонализированный совет на основе запроса.
@@ -165,6 +205,8 @@ class EnhancedFinancialAdvisor:
             user_query: Вопрос пользователя
             use_local: Использовать локальную модель (Ollama)
             anonymize: Анонимизировать данные перед отправкой в облако
+            use_cache: Переиспользовать ответ на такой же вопрос при тех же данных.
+                None — решить по типу запроса (CACHEABLE_QUERY_TYPES)
             
         Returns:
             Dict с ответом и метаданными
@@ -175,59 +217,220 @@ class EnhancedFinancialAdvisor:
         # 2. Строим обогащенный контекст
         enriched_context = build_enriched_context(self.user, query_analysis)
         
-        # 3. Формируем системный промпт
-        system_prompt = ADVANCED_FINANCIAL_PROMPT.format(
-            enriched_context=enriched_context
+        # 3. Проверяем кэш ответов на такие же вопросы
+        use_cache = self._should_use_cache(query_analysis, use_local, use_cache)
+        response = None
+        if use_cache:
+            response = get_cached_response(self.user.id, user_query, enriched_context)
+        cached = response is not None
+        
+        usage = {}
+        if not cached:
+            # 4. Получаем историю диалога если есть сессия
+            messages = self._load_history()
+            
+            # 5. Получаем ответ от LLM
+            response = self._call_llm(user_query, enriched_context, messages, use_local, anonymize, usage)
+            if use_cache:
+                store_response(self.user.id, user_query, enriched_context, response)
+        
+        # 6. Обновляем timestamp сессии если есть
+        if self.session:
+            self.session.save(update_fields=['updated_at'])
+        
+        return self._build_result(query_analysis, enriched_context, response, usage, cached)
+    
+    def stream_advice(
+        self,
+        user_query: str,
+        use_local: bool = False,
+        anonymize: bool = True,
+        use_cache: Optional[bool] = None
+    ) -> Generator[str, None, Dict[str, Any]]:
+        """
+        Потоковая версия get_advice: отдает фрагменты ответа по мере генерации.
+        Итоговый словарь (как у get_advice) возвращается из генератора
+        (значение StopIteration / результат yield from).
+        Обрыв потока LLM пробрасывается как исключение — ответ не кэшируется.
+        """
+        query_analysis = analyze_query(user_query)
+        enriched_context = build_enriched_context(self.user, query_analysis)
+        
+        use_cache = self._should_use_cache(query_analysis, use_local, use_cache)
+        response = None
+        if use_cache:
+            response = get_cached_response(self.user.id, user_query, enriched_context)
+        cached = response is not None
+        
+        usage = {}
+        if cached:
+            yield response
+        else:
+            messages = self._load_history()
+            parts = []
+            for chunk in stream_chat_with_context(
+                **self._llm_kwargs(user_query, enriched_context, messages, use_local, anonymize, usage)
+            ):
+                parts.append(chunk)
+                yield chunk
+            response = ''.join(parts)
+            if use_cache:
+                store_response(self.user.id, user_query, enriched_context, response)
+        
+        if self.session:
+            self.session.save(update_fields=['updated_at'])
+        
+        return self._build_result(query_analysis, enriched_context, response, usage, cached)
+    
+    async def aget_advice(
+        self,
+        user_query: str,
+        use_local: bool = False,
+        anonymize: bool = True,
+        use_cache: Optional[bool] = None
+    ) -> Dict[str, Any]:
+        """
+        Асинхронная версия get_advice.
+        
+        Построение контекста и загрузка истории диалога независимы,
+        поэтому выполняются параллельно до вызова LLM.
+        """
+        query_analysis = analyze_query(user_query)
+        
+        enriched_context, messages = await asyncio.gather(
+            _db_call(build_enriched_context)(self.user, query_analysis),
+            _db_call(self._load_history)(),
         )
         
-        # 4. Получаем историю диалога если есть сессия
-        messages = []
+        use_cache = self._should_use_cache(query_analysis, use_local, use_cache)
+        response = None
+        if use_cache:
+            response = await _db_call(get_cached_response)(self.user.id, user_query, enriched_context)
+        cached = response is not None
+        
+        usage = {}
+        if not cached:
+            response = await _db_call(self._call_llm)(
+                user_query, enriched_context, messages, use_local, anonymize, usage
+            )
+            if use_cache:
+                await _db_call(store_response)(self.user.id, user_query, enriched_context, response)
+        
         if self.session:
-            # Берем последние 10 сообщений для контекста
-            history = ChatMessage.objects.filter(
-                session=self.session
-            ).order_by('-created_at')[:10]
-            
-            for msg in reversed(list(history)):
-                messages.append({
-                    'role': msg.role,
-                    'content': msg.content
-                })
+            await self.session.asave(update_fields=['updated_at'])
+        
+        return self._build_result(query_analysis, enriched_context, response, usage, cached)
+    
+    @staticmethod
+    def _should_use_cache(
+        query_analysis: QueryAnalysis,
+        use_local: bool,
+        use_cache: Optional[bool]
+    ) -> bool:
+        """Определяет, можно ли брать ответ из кэша"""
+        if use_local:
+            # Локальная модель бесплатна, кэш не нужен
+            return False
+        if use_cache is not None:
+            return use_cache
+        return query_analysis.query_type in CACHEABLE_QUERY_TYPES
+    
+    def _load_history(self) -> List[Dict[str, str]]:
+        """Загружает последние 10 сообщений сессии в хронологическом порядке"""
+        if not self.session:
+            return []
+        
+        # Подзапрос выбирает id последних 10 сообщений, внешний запрос
+        # сразу сортирует их по возрастанию — без reversed() и моделей
+        last_ids = ChatMessage.objects.filter(
+            session=self.session
+        ).order_by('-created_at').values('id')[:10]
+        
+        return list(
+            ChatMessage.objects.filter(id__in=last_ids)
+            .order_by('created_at')
+            .values('role', 'content')
+        )
+    
+    def _call_llm(
+        self,
+        user_query: str,
+        enriched_context: str,
+        messages: List[Dict[str, str]],
+        use_local: bool,
+        anonymize: bool,
+        usage: Dict[str, int]
+    ) -> str:
+        """Отправляет запрос в LLM с системным промптом и историей"""
+        return chat_with_context(
+            **self._llm_kwargs(user_query, enriched_context, messages, use_local, anonymize, usage)
+        )
+    
+    def _llm_kwargs(
+        self,
+        user_query: str,
+        enriched_context: str,
+        messages: List[Dict[str, str]],
+        use_local: bool,
+        anonymize: bool,
+        usage: Dict[str, int]
+    ) -> Dict[str, Any]:
+        """Аргументы chat_with_context / stream_chat_with_context для запроса"""
+        # Статический префикс кэшируется провайдером,
+        # контекст пользователя передаётся последним блоком
+        system_blocks = [
+            {
+                'type': 'text',
+                'text': STATIC_SYSTEM_PROMPT,
+                'cache_control': {'type': 'ephemeral'},
+            },
+            {
+                'type': 'text',
+                'text': _CONTEXT_PREFIX + enriched_context + _CONTEXT_SUFFIX,
+            },
+        ]
         
         # Добавляем текущий запрос
-        messages.append({
+        messages = messages + [{
             'role': 'user',
             'content': user_query
-        })
+        }]
         
-        # 5. Получаем ответ от LLM
-        response = chat_with_context(
+        return dict(
             messages=messages,
-            user_data="",  # Уже включено в system_prompt через format
+            user_data="",  # Уже включено в system_blocks
             session=self.session,
             check_duplicates=True,
             anonymize=anonymize,
             use_local=use_local,
             user=self.user,
-            system_instruction=system_prompt  # <-- Передаем наш кастомный промпт
+            system_blocks=system_blocks,  # <-- Передаем наш кастомный промпт
+            usage=usage
         )
-        
-        # 6. Обновляем timestamp сессии если есть
-        if self.session:
-            self.session.save()
-        
+    
+    @staticmethod
+    def _build_result(
+        query_analysis: QueryAnalysis,
+        enriched_context: str,
+        response: str,
+        usage: Dict[str, int],
+        cached: bool = False
+    ) -> Dict[str, Any]:
+        """Собирает ответ советчика с метаданными"""
         return {
             'response': response,
-            'query_type': query_analysis['query_type'],
+            'query_type': query_analysis.query_type,
             'context_used': {
-                'categories': query_analysis.get('categories', []),
-                'time_period': query_analysis.get('time_period', {}),
-                'priority': query_analysis.get('context_priority', []),
+                'categories': query_analysis.categories,
+                'time_period': query_analysis.time_period,
+                'priority': query_analysis.context_priority,
             },
             'metadata': {
-                'requires_forecast': query_analysis.get('requires_forecast', False),
-                'requires_comparison': query_analysis.get('requires_comparison', False),
+                'requires_forecast': query_analysis.requires_forecast,
+                'requires_comparison': query_analysis.requires_comparison,
                 'context_size': len(enriched_context),
+                'cache_read_input_tokens': usage.get('cache_read_input_tokens', 0),
+                'response_cached': cached,
             }
         }
     
@@ -239,12 +442,23 @@ class EnhancedFinancialAdvisor:
         Returns:
             Dict с инсайтами и рекомендациями
         """
+        # Сначала берём результат ночного пересчёта — без обращения к LLM
+        payload = QuickInsightCache.objects.filter(
+            user=self.user,
+            generated_at__gte=timezone.now() - QUICK_INSIGHTS_MAX_AGE
+        ).values_list('payload', flat=True).first()
+        if payload is not None:
+            return payload
+        
         # Используем специальный запрос для общего анализа
-        return self.get_advice(
-            "Give a brief analysis of my financial situation and give 2-3 most important tips right now.",
+        result = self.get_advice(
+            QUICK_INSIGHTS_QUERY,
             use_local=False,
-            anonymize=True
+            anonymize=True,
+            use_cache=True
         )
+        save_quick_insights(self.user, result)
+        return result
 
 
 def get_financial_advice(
@@ -267,3 +481,64 @@ def get_financial_advice(
     """
     advisor = EnhancedFinancialAdvisor(user, session)
     return advisor.get_advice(query, **kwargs)
+
+
+def stream_financial_advice(
+    user,
+    query: str,
+    session: Optional[ChatSession] = None,
+    **kwargs
+) -> Generator[str, None, Dict[str, Any]]:
+    """
+    Потоковый вариант get_financial_advice: генератор фрагментов ответа,
+    возвращающий в конце тот же словарь с ответом и метаданными.
+    """
+    advisor = EnhancedFinancialAdvisor(user, session)
+    return advisor.stream_advice(query, **kwargs)
+
+
+def save_quick_insights(user, result: Dict[str, Any]) -> bool:
+    """
+    Сохраняет инсайты дашборда пользователя.
+    Ответы с ошибками LLM не сохраняются.
+    
+    Returns:
+        True если инсайты сохранены
+    """
+    response = result.get('response')
+    if not response or response.startswith('['):
+        return False
+    
+    QuickInsightCache.objects.update_or_create(
+        user=user,
+        defaults={'payload': result, 'generated_at': timezone.now()}
+    )
+    return True
+
+
+async def get_advice_batch(
+    users,
+    query: str = QUICK_INSIGHTS_QUERY,
+    concurrency: int = 16,
+    **kwargs
+) -> List[Dict[str, Any]]:
+    """
+    Получает советы для нескольких пользователей параллельно.
+    Полезно для пакетной генерации инсайтов дашборда.
+    
+    Args:
+        users: Итерируемый набор Django User objects
+        query: Вопрос (по умолчанию — быстрые инсайты)
+        concurrency: Максимум одновременных запросов к LLM
+        **kwargs: Дополнительные параметры (use_local, anonymize)
+        
+    Returns:
+        List результатов в том же порядке, что и users
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def one(user):
+        async with semaphore:
+            return await EnhancedFinancialAdvisor(user).aget_advice(query, **kwargs)
+    
+    return await asyncio.gather(*(one(user) for user in users))
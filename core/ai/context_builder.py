@@ -3,9 +3,13 @@
 Собирает релевантную информацию из разных источников.
 """
 
+import bisect
+from itertools import islice
 from typing import Dict, List, Any, Optional
 from datetime import date, datetime, timedelta
-from django.db.models import Sum, Avg, Count, Q
+from django.db import connection
+from django.db.models import Sum, Avg, Count, Min, F, Q, Value
+from django.core.cache import cache
 from collections import defaultdict
 
 from core.models import Income, Expense, ChatMessage
@@ -14,6 +18,24 @@ from core.utils.analytics import (
     _format_currency,
     _month_key,
 )
+from core.utils.cache import user_cache_key
+from core.ai.query_analyzer import QueryAnalysis, category_type_codes
+
+
+# Время жизни кэша (секунды)
+CONTEXT_CACHE_TIMEOUT = 300
+PROFILE_CACHE_TIMEOUT = 3600
+
+# Сколько последних доходов/расходов показывать в контексте
+RECENT_TRANSACTIONS_LIMIT = 5
+
+# Подписи трендов для секции Trends
+_TREND_LABELS = {
+    'growth': '📈 Growth',
+    'decline': '📉 Decline',
+    'stable': '➡️ Stable',
+}
+_TREND_ICONS = {'growth': '📈', 'decline': '📉'}
 
 
 class ContextBuilder:
@@ -26,7 +48,7 @@ class ContextBuilder:
         self.user = user
         self.context = {}
     
-    def build(self, query_analysis: Dict[str, Any], max_context_size: int = 10000) -> str:
+    def build(self, query_analysis: QueryAnalysis, max_context_size: int = 10000) -> str:
         """
         Строит контекст для AI в формате markdown.
         
@@ -37,20 +59,48 @@ class ContextBuilder:
         Returns:
             Markdown-форматированный контекст
         """
-        priority = query_analysis.get('context_priority', ['tables', 'trends'])
-        time_period = query_analysis.get('time_period', {})
-        categories = query_analysis.get('categories', [])
+        priority = query_analysis.context_priority
+        time_period = query_analysis.time_period
+        categories = query_analysis.categories
         
         sections = []
+        running_len = 0
+        truncated = False
         
-        # Собираем секции в порядке приоритета
+        # Профиль пользователя идёт первым (не зависит от запроса, кэшируется дольше)
+        profile_key = user_cache_key('ctx_profile', self.user.id, date.today().isoformat())
+        profile_section = cache.get(profile_key)
+        if profile_section is None:
+            profile_section = self._build_user_profile_section()
+            cache.set(profile_key, profile_section, PROFILE_CACHE_TIMEOUT)
+        if profile_section:
+            if len(profile_section) > max_context_size:
+                profile_section = profile_section[:max_context_size]
+                truncated = True
+            sections.append(profile_section)
+            running_len = len(profile_section)
+        
+        # Финансовая память нужна нескольким секциям — загружаем один раз
+        try:
+            memory = get_user_financial_memory(self.user, force_refresh=False)
+        except Exception:
+            memory = {}
+        
+        # Собираем секции в порядке приоритета, пока хватает бюджета:
+        # секции, которые всё равно были бы обрезаны, не строятся вовсе
         for data_type in priority:
+            separator_len = 2 if sections else 0  # "\n\n" между секциями
+            remaining = max_context_size - running_len - separator_len
+            if truncated or remaining <= 0:
+                truncated = True
+                break
+            
             if data_type == 'tables':
-                section = self._build_tables_section(time_period)
+                section = self._build_tables_section(memory, time_period)
             elif data_type == 'trends':
-                section = self._build_trends_section(time_period)
+                section = self._build_trends_section(memory, time_period)
             elif data_type == 'anomalies':
-                section = self._build_anomalies_section(time_period)
+                section = self._build_anomalies_section(memory, time_period)
             elif data_type == 'transactions':
                 section = self._build_transactions_section(time_period, categories)
             elif data_type == 'goals':
@@ -58,28 +108,27 @@ class ContextBuilder:
             else:
                 continue
             
-            if section:
-                sections.append(section)
-        
-        # Добавляем профиль пользователя
-        profile_section = self._build_user_profile_section()
-        if profile_section:
-            sections.insert(0, profile_section)
+            if not section:
+                continue
+            
+            # Обрезаем секцию до оставшегося бюджета
+            if len(section) > remaining:
+                section = section[:remaining]
+                truncated = True
+            
+            sections.append(section)
+            running_len += separator_len + len(section)
         
-        # Объединяем все секции
         full_context = "\n\n".join(sections)
         
-        # Обрезаем если слишком длинный
-        if len(full_context) > max_context_size:
-            full_context = full_context[:max_context_size] + "\n\n[Context truncated for optimization]"
+        if truncated:
+            full_context += "\n\n[Context truncated for optimization]"
         
         return full_context
     
-    def _build_tables_section(self, time_period: Dict[str, Any]) -> str:
+    def _build_tables_section(self, memory: Dict[str, Any], time_period: Dict[str, Any]) -> str:
         """Строит секцию с таблицами и статистикой"""
         try:
-            memory = get_user_financial_memory(self.user, force_refresh=False)
-            
             # Фильтруем по периоду если указан
             if time_period.get('start_date'):
                 filtered_months = self._filter_months_by_period(
@@ -97,10 +146,9 @@ class ContextBuilder:
         except Exception as e:
             return f"## 📊 Financial Statistics\n\n_Error loading statistics: {e}_"
     
-    def _build_trends_section(self, time_period: Dict[str, Any]) -> str:
+    def _build_trends_section(self, memory: Dict[str, Any], time_period: Dict[str, Any]) -> str:
         """Строит секцию с трендами"""
         try:
-            memory = get_user_financial_memory(self.user, force_refresh=False)
             trends = memory.get('trends', {})
             
             if not trends.get('has_enough_data'):
@@ -112,22 +160,16 @@ class ContextBuilder:
             income_trend = trends.get('income_trend', 'stable')
             expense_trend = trends.get('expense_trend', 'stable')
             
-            trend_emoji = {
-                'growth': '📈 Growth',
-                'decline': '📉 Decline',
-                'stable': '➡️ Stable'
-            }
-            
             lines.append(f"\n**General Trends:**")
-            lines.append(f"- Income: {trend_emoji.get(income_trend, income_trend)}")
-            lines.append(f"- Expenses: {trend_emoji.get(expense_trend, expense_trend)}")
+            lines.append(f"- Income: {_TREND_LABELS.get(income_trend, income_trend)}")
+            lines.append(f"- Expenses: {_TREND_LABELS.get(expense_trend, expense_trend)}")
             
             # Category trends
             cat_trends = trends.get('category_trends', {})
             if cat_trends:
                 lines.append(f"\n**Expense Category Trends:**")
-                for cat, data in list(cat_trends.items())[:5]:
-                    emoji = "📈" if data['trend'] == 'growth' else "📉" if data['trend'] == 'decline' else "➡️"
+                for cat, data in islice(cat_trends.items(), 5):
+                    emoji = _TREND_ICONS.get(data['trend'], "➡️")
                     lines.append(
                         f"- {cat}: {emoji} {data['change_pct']:+.1f}%, "
                         f"avg: {_format_currency(data['average'])}"
@@ -137,10 +179,9 @@ class ContextBuilder:
         except Exception as e:
             return f"## 📈 Trends\n\n_Error: {e}_"
     
-    def _build_anomalies_section(self, time_period: Dict[str, Any]) -> str:
+    def _build_anomalies_section(self, memory: Dict[str, Any], time_period: Dict[str, Any]) -> str:
         """Строит секцию с аномалиями"""
         try:
-            memory = get_user_financial_memory(self.user, force_refresh=False)
             alerts = memory.get('alerts', [])
             
             if not alerts:
@@ -170,38 +211,55 @@ class ContextBuilder:
             if time_period.get('end_date'):
                 query_filter &= Q(date__lte=time_period['end_date'])
             
-            # Фильтруем по категориям если указаны
-            if categories:
-                cat_filter = Q()
-                for cat in categories:
-                    cat_filter |= Q(category__icontains=cat)
-                query_filter &= cat_filter
-            
-            incomes = Income.objects.filter(query_filter).order_by('-date')[:10]
-            expenses = Expense.objects.filter(query_filter).order_by('-date')[:10]
+            # Фильтруем по категориям если указаны. Ключевые слова запроса
+            # ('еда', 'аренда', ...) переводим в коды типов БД ('food', 'rent'),
+            # после чего достаточно точного совпадения (IN)
+            income_filter = query_filter
+            expense_filter = query_filter
+            type_codes = category_type_codes(categories)
+            if type_codes:
+                income_filter &= Q(income_type__in=type_codes)
+                expense_filter &= Q(expense_type__in=type_codes)
+            
+            # Последние доходы и расходы одним запросом (UNION ALL)
+            fields = ('kind', 'date', 'amount', 'category', 'description')
+            incomes_qs = Income.objects.filter(income_filter).annotate(
+                kind=Value('inc'), category=F('income_type')
+            ).values_list(*fields).order_by('-date')[:RECENT_TRANSACTIONS_LIMIT]
+            expenses_qs = Expense.objects.filter(expense_filter).annotate(
+                kind=Value('exp'), category=F('expense_type')
+            ).values_list(*fields).order_by('-date')[:RECENT_TRANSACTIONS_LIMIT]
+            
+            if connection.features.supports_slicing_ordering_in_compound:
+                rows = list(incomes_qs.union(expenses_qs, all=True))
+            else:
+                # SQLite не поддерживает LIMIT внутри UNION — два запроса
+                rows = list(incomes_qs) + list(expenses_qs)
+            incomes = [row[1:] for row in rows if row[0] == 'inc']
+            expenses = [row[1:] for row in rows if row[0] == 'exp']
             
             lines = ["## 💰 Recent Transactions"]
             
-            if categories:
-                lines.append(f"\n**Filter:** {', '.join(categories)}")
+            if type_codes:
+                lines.append(f"\n**Filter:** {', '.join(type_codes)}")
             
-            if incomes.exists():
+            if incomes:
                 lines.append("\n**Income:**")
-                for inc in incomes[:5]:
+                for d, amount, cat, desc in incomes:
                     lines.append(
-                        f"- {inc.date.strftime('%d.%m.%Y')}: "
-                        f"{_format_currency(inc.amount)} ({inc.category}) - {inc.description or 'no description'}"
+                        f"- {d.strftime('%d.%m.%Y')}: "
+                        f"{_format_currency(amount)} ({cat}) - {desc or 'no description'}"
                     )
             
-            if expenses.exists():
+            if expenses:
                 lines.append("\n**Expenses:**")
-                for exp in expenses[:5]:
+                for d, amount, cat, desc in expenses:
                     lines.append(
-                        f"- {exp.date.strftime('%d.%m.%Y')}: "
-                        f"{_format_currency(exp.amount)} ({exp.category}) - {exp.description or 'no description'}"
+                        f"- {d.strftime('%d.%m.%Y')}: "
+                        f"{_format_currency(amount)} ({cat}) - {desc or 'no description'}"
                     )
             
-            if not incomes.exists() and not expenses.exists():
+            if not incomes and not expenses:
                 lines.append("\n_No transactions found for the specified filters_")
             
             return "\n".join(lines)
@@ -217,27 +275,37 @@ class ContextBuilder:
     def _build_user_profile_section(self) -> str:
         """Строит секцию с профилем поведения пользователя"""
         try:
-            # Анализируем паттерны поведения
-            total_income = Income.objects.filter(user=self.user).aggregate(
+            # Анализируем паттерны поведения: статистика доходов и расходов
+            # одним запросом (UNION ALL двух агрегатов)
+            stats = {
+                'inc': {'total': None, 'avg': None, 'count': 0, 'first_date': None},
+                'exp': {'total': None, 'avg': None, 'count': 0, 'first_date': None},
+            }
+            aggregates = dict(
                 total=Sum('amount'),
                 avg=Avg('amount'),
-                count=Count('id')
+                count=Count('id'),
+                first_date=Min('date'),
             )
+            income_stats = Income.objects.filter(user=self.user).values('user').annotate(
+                kind=Value('inc'), **aggregates
+            ).values('kind', 'total', 'avg', 'count', 'first_date')
+            expense_stats = Expense.objects.filter(user=self.user).values('user').annotate(
+                kind=Value('exp'), **aggregates
+            ).values('kind', 'total', 'avg', 'count', 'first_date')
             
-            total_expense = Expense.objects.filter(user=self.user).aggregate(
-                total=Sum('amount'),
-                avg=Avg('amount'),
-                count=Count('id')
-            )
+            for row in income_stats.union(expense_stats, all=True):
+                stats[row['kind']] = row
+            
+            total_income = stats['inc']
+            total_expense = stats['exp']
             
             # Количество месяцев с данными
-            first_transaction = Income.objects.filter(user=self.user).order_by('date').first()
-            if not first_transaction:
-                first_transaction = Expense.objects.filter(user=self.user).order_by('date').first()
+            first_dates = [d for d in (total_income['first_date'], total_expense['first_date']) if d]
             
             months_active = 0
-            if first_transaction:
-                delta = date.today() - first_transaction.date
+            if first_dates:
+                delta = date.today() - min(first_dates)
                 months_active = delta.days // 30
             
             lines = ["## 👤 User Profile"]
@@ -285,12 +353,11 @@ class ContextBuilder:
         start_key = _month_key(time_period['start_date'])
         end_key = _month_key(time_period.get('end_date', date.today()))
         
-        filtered = {}
-        for key in ordered_keys:
-            if start_key <= key <= end_key:
-                filtered[key] = months[key]
+        # ordered_keys отсортированы — находим границы периода бинарным поиском
+        lo = bisect.bisect_left(ordered_keys, start_key)
+        hi = bisect.bisect_right(ordered_keys, end_key)
         
-        return filtered
+        return {key: months[key] for key in ordered_keys[lo:hi]}
     
     def _build_custom_table(self, months: Dict[str, Any]) -> str:
         """Строит custom таблицу для отфильтрованных месяцев"""
@@ -311,9 +378,11 @@ class ContextBuilder:
         return "\n".join(lines)
 
 
-def build_enriched_context(user, query_analysis: Dict[str, Any]) -> str:
+def build_enriched_context(user, query_analysis: QueryAnalysis) -> str:
     """
     Удобная функция для построения контекста.
+    Результат кэшируется на CONTEXT_CACHE_TIMEOUT секунд и сбрасывается
+    при изменении транзакций пользователя.
     
     Args:
         user: Django User object
@@ -322,5 +391,19 @@ def build_enriched_context(user, query_analysis: Dict[str, Any]) -> str:
     Returns:
         Markdown-форматированный контекст
     """
-    builder = ContextBuilder(user)
-    return builder.build(query_analysis)
+    time_period = query_analysis.time_period
+    key = user_cache_key(
+        'ctx',
+        user.id,
+        tuple(query_analysis.context_priority),
+        (time_period.get('start_date'), time_period.get('end_date')),
+        tuple(query_analysis.categories),
+    )
+    
+    context = cache.get(key)
+    if context is None:
+        builder = ContextBuilder(user)
+        context = builder.build(query_analysis)
+        cache.set(key, context, CONTEXT_CACHE_TIMEOUT)
+    
+    return context
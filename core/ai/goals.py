@@ -3,9 +3,12 @@
 Позволяет отслеживать прогресс достижения целей и давать рекомендации.
 """
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Least, Round
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator
+from django.utils import timezone
 from datetime import date
 
 
@@ -99,7 +102,7 @@ class FinancialGoal(models.Model):
     metadata = models.JSONField(
         default=dict,
         blank=True,
-        help_text='Дополнительные данные (история взносов, заметки)'
+        help_text='Дополнительные данные (заметки)'
     )
     
     class Meta:
@@ -119,6 +122,26 @@ class FinancialGoal(models.Model):
         progress = (self.current_amount / self.target_amount) * 100
         return min(round(progress, 2), 100)
     
+    @classmethod
+    def bulk_progress(cls, queryset=None):
+        """
+        Аннотирует цели полем progress (процент выполнения) на стороне БД.
+        Для списков целей — один запрос вместо вызова
+        get_progress_percentage() для каждой цели.
+        """
+        if queryset is None:
+            queryset = cls.objects.all()
+        return queryset.annotate(
+            progress=Case(
+                When(target_amount__lte=0, then=Value(0.0)),
+                default=Least(
+                    Round(F('current_amount') * 100.0 / F('target_amount'), 2),
+                    Value(100.0),
+                ),
+                output_field=models.FloatField(),
+            )
+        )
+    
     def get_remaining_amount(self):
         """Возвращает оставшуюся сумму до цели"""
         return max(0, self.target_amount - self.current_amount)
@@ -148,24 +171,28 @@ class FinancialGoal(models.Model):
     
     def update_progress(self, amount):
         """Обновляет прогресс цели"""
-        self.current_amount += amount
-        
-        # Обновляем историю взносов
-        history = self.metadata.get('contribution_history', [])
-        history.append({
-            'amount': amount,
-            'date': date.today().isoformat(),
-            'current_total': self.current_amount
-        })
-        self.metadata['contribution_history'] = history
-        
-        # Проверяем выполнение
-        if self.current_amount >= self.target_amount:
-            self.status = 'completed'
-            from django.utils import timezone
-            self.completed_at = timezone.now()
-        
-        self.save()
+        with transaction.atomic():
+            # Атомарное увеличение суммы (без гонок между параллельными взносами)
+            FinancialGoal.objects.filter(pk=self.pk).update(
+                current_amount=F('current_amount') + amount,
+                updated_at=timezone.now()
+            )
+            self.refresh_from_db(fields=['current_amount', 'updated_at'])
+            
+            # История взносов — отдельная таблица, запись за O(1)
+            GoalContribution.objects.create(
+                goal=self,
+                amount=amount,
+                date=date.today(),
+                running_total=self.current_amount
+            )
+            
+            # Проверяем выполнение
+            if self.current_amount >= self.target_amount:
+                self.status = 'completed'
+                self.completed_at = timezone.now()
+                # current_amount уже записан через F(), история — в GoalContribution
+                self.save(update_fields=['status', 'completed_at', 'updated_at'])
     
     def get_recommendation(self):
         """Возвращает рекомендацию по достижению цели"""
@@ -193,6 +220,27 @@ class FinancialGoal(models.Model):
         return "📊 Следуйте текущему плану взносов"
 
 
+class GoalContribution(models.Model):
+    """
+    Взнос в финансовую цель (история пополнений).
+    """
+    goal = models.ForeignKey(
+        FinancialGoal,
+        on_delete=models.CASCADE,
+        related_name='contributions'
+    )
+    
+    amount = models.FloatField()
+    date = models.DateField()
+    running_total = models.FloatField(help_text='Накопленная сумма после взноса')
+    
+    class Meta:
+        ordering = ['date', 'id']
+    
+    def __str__(self):
+        return f"{self.goal.title}: {self.amount:,.0f} ({self.date})"
+
+
 class GoalMilestone(models.Model):
     """
     Промежуточные вехи для финансовых целей.
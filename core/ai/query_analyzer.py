@@ -4,9 +4,13 @@
 """
 
 import re
-from typing import Dict, List, Any, Tuple
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Any, Optional, Set, Tuple
 from datetime import datetime, date, timedelta
 
+from core.ai.keyword_matcher import KeywordMatcher
+
 
 class QueryType:
     """Типы финансовых запросов"""
@@ -20,6 +24,23 @@ class QueryType:
     GENERAL = 'general'         # Общие вопросы
 
 
+# Все типы в порядке объявления (при равенстве очков побеждает более ранний)
+_QUERY_TYPES = tuple(val for key, val in vars(QueryType).items() if not key.startswith('_'))
+
+
+@dataclass(slots=True)
+class QueryAnalysis:
+    """Результат анализа запроса"""
+    query_type: str
+    categories: List[str] = field(default_factory=list)
+    time_period: Dict[str, Any] = field(default_factory=dict)
+    amounts: List[float] = field(default_factory=list)
+    context_priority: List[str] = field(default_factory=lambda: ['tables', 'trends'])
+    requires_deep_search: bool = False
+    requires_forecast: bool = False
+    requires_comparison: bool = False
+
+
 class QueryAnalyzer:
     """
     Анализатор запросов для определения намерений пользователя
@@ -65,6 +86,34 @@ class QueryAnalyzer:
         ],
     }
     
+    # Категории, которые ищем в запросе
+    CATEGORY_KEYWORDS = [
+        'еда', 'продукты', 'питание', 'food',
+        'транспорт', 'бензин', 'transport',
+        'развлечения', 'entertainment',
+        'здоровье', 'медицина', 'health',
+        'одежда', 'clothes',
+        'образование', 'education',
+        'жилье', 'аренда', 'коммунал', 'housing', 'rent',
+        'зарплата', 'salary',
+        'маркетинг', 'реклама', 'marketing',
+        'офис', 'office',
+    ]
+    
+    # Коды income_type/expense_type в БД для ключевых слов категорий
+    # (слова без подходящего кода, например 'офис', в фильтр не попадают)
+    CATEGORY_TYPE_CODES = {
+        'еда': 'food', 'продукты': 'food', 'питание': 'food', 'food': 'food',
+        'транспорт': 'transport', 'бензин': 'transport', 'transport': 'transport',
+        'развлечения': 'entertainment', 'entertainment': 'entertainment',
+        'здоровье': 'health', 'медицина': 'health', 'health': 'health',
+        'одежда': 'shopping', 'clothes': 'shopping',
+        'образование': 'education', 'education': 'education',
+        'жилье': 'rent', 'аренда': 'rent', 'коммунал': 'rent', 'housing': 'rent', 'rent': 'rent',
+        'зарплата': 'salary', 'salary': 'salary',
+        'маркетинг': 'marketing', 'реклама': 'marketing', 'marketing': 'marketing',
+    }
+    
     # Временные маркеры
     TIME_MARKERS = {
         'сегодня': 0,
@@ -82,14 +131,31 @@ class QueryAnalyzer:
         'year': 365,
     }
     
-    def __init__(self):
-        self.query_text = ""
-        self.detected_types = []
-        self.detected_categories = []
-        self.detected_time_period = None
-        self.detected_amounts = []
+    # Названия (основы) месяцев
+    MONTHS = {
+        'январ': 1, 'феврал': 2, 'март': 3, 'апрел': 4,
+        'ма': 5, 'июн': 6, 'июл': 7, 'август': 8,
+        'сентябр': 9, 'октябр': 10, 'ноябр': 11, 'декабр': 12,
+        'january': 1, 'february': 2, 'march': 3, 'april': 4,
+        'may': 5, 'june': 6, 'july': 7, 'august': 8,
+        'september': 9, 'october': 10, 'november': 11, 'december': 12,
+        'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4,
+        'jun': 6, 'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12,
+    }
     
-    def analyze(self, query: str) -> Dict[str, Any]:
+    # Приоритет данных для контекста по типу запроса
+    CONTEXT_PRIORITIES = {
+        QueryType.TRENDS: ('trends', 'tables', 'anomalies'),
+        QueryType.ANOMALIES: ('anomalies', 'transactions', 'tables'),
+        QueryType.ADVICE: ('trends', 'anomalies', 'goals', 'tables'),
+        QueryType.COMPARISON: ('tables', 'trends'),
+        QueryType.FORECAST: ('trends', 'tables', 'goals'),
+        QueryType.SPECIFIC: ('transactions', 'tables'),
+        QueryType.GOALS: ('goals', 'trends', 'tables'),
+        QueryType.GENERAL: ('tables', 'trends', 'anomalies'),
+    }
+    
+    def analyze(self, query: str) -> QueryAnalysis:
         """
         Анализирует запрос и возвращает структурированную информацию.
         
@@ -97,76 +163,56 @@ class QueryAnalyzer:
             query: Текст запроса пользователя
             
         Returns:
-            Dict с типом запроса, категориями, периодами и т.д.
+            QueryAnalysis с типом запроса, категориями, периодами и т.д.
         """
-        self.query_text = query.lower()
-        
-        # Определяем тип запроса
-        query_type = self._detect_query_type()
-        
-        # Извлекаем категории
-        categories = self._extract_categories()
+        text = query.lower()
         
-        # Извлекаем временной период
-        time_period = self._extract_time_period()
+        # Всё, что зависит только от текста, берём из кэша
+        query_type, categories, amounts, time_marker, month = _analyze_text(text)
         
-        # Извлекаем суммы
-        amounts = self._extract_amounts()
+        # Даты периода зависят от текущего дня, считаем каждый раз
+        time_period = self._extract_time_period(text, time_marker, month)
         
         # Определяем приоритет данных для контекста
         context_priority = self._get_context_priority(query_type)
         
-        return {
-            'query_type': query_type,
-            'categories': categories,
-            'time_period': time_period,
-            'amounts': amounts,
-            'context_priority': context_priority,
-            'requires_deep_search': query_type in [QueryType.SPECIFIC, QueryType.ANOMALIES],
-            'requires_forecast': query_type == QueryType.FORECAST,
-            'requires_comparison': query_type == QueryType.COMPARISON,
-        }
+        return QueryAnalysis(
+            query_type=query_type,
+            categories=list(categories),
+            time_period=time_period,
+            amounts=list(amounts),
+            context_priority=context_priority,
+            requires_deep_search=query_type in (QueryType.SPECIFIC, QueryType.ANOMALIES),
+            requires_forecast=query_type == QueryType.FORECAST,
+            requires_comparison=query_type == QueryType.COMPARISON,
+        )
     
-    def _detect_query_type(self) -> str:
-        """Определяет тип запроса по ключевым словам"""
-        scores = {val: 0 for key, val in QueryType.__dict__.items() if not key.startswith('_')}
+    @staticmethod
+    def _detect_query_type(hits: Set[str]) -> str:
+        """Определяет тип запроса по найденным ключевым словам"""
+        matched = [_KEYWORD_TYPE_IDS[keyword] for keyword in hits if keyword in _KEYWORD_TYPE_IDS]
+        if not matched:
+            return QueryType.GENERAL
         
-        for query_type, keywords in self.KEYWORDS.items():
-            for keyword in keywords:
-                if keyword in self.query_text:
-                    scores[query_type] += 1
+        # Все найденные слова одного типа (частый случай) — считать очки не нужно
+        if matched.count(matched[0]) == len(matched):
+            return _QUERY_TYPES[matched[0]]
         
-        # Возвращаем тип с максимальным score
-        max_score = max(scores.values())
-        if max_score > 0:
-            return max(scores.items(), key=lambda x: x[1])[0]
+        scores = [0] * len(_QUERY_TYPES)
+        for type_id in matched:
+            scores[type_id] += 1
         
-        return QueryType.GENERAL
+        # Тип с максимальным score; при равенстве — объявленный раньше
+        return _QUERY_TYPES[scores.index(max(scores))]
     
-    def _extract_categories(self) -> List[str]:
-        """Извлекает упомянутые категории из запроса"""
-        common_categories = [
-            'еда', 'продукты', 'питание', 'food',
-            'транспорт', 'бензин', 'transport',
-            'развлечения', 'entertainment',
-            'здоровье', 'медицина', 'health',
-            'одежда', 'clothes',
-            'образование', 'education',
-            'жилье', 'аренда', 'коммунал', 'housing', 'rent',
-            'зарплата', 'salary',
-            'маркетинг', 'реклама', 'marketing',
-            'офис', 'office',
-        ]
-        
-        found = []
-        for cat in common_categories:
-            if cat in self.query_text:
-                found.append(cat)
-        
-        return found
+    @staticmethod
+    def _extract_categories(hits: Set[str]) -> List[str]:
+        """Извлекает упомянутые категории из найденных ключевых слов"""
+        return [cat for cat in QueryAnalyzer.CATEGORY_KEYWORDS if cat in hits]
     
-    def _extract_time_period(self) -> Dict[str, Any]:
-        """Извлекает временной период из запроса"""
+    @staticmethod
+    def _extract_time_period(text: str, time_marker: Optional[str], month: Optional[str]) -> Dict[str, Any]:
+        """Строит временной период по первым упомянутым маркеру времени и месяцу"""
         result = {
             'type': None,  # 'last_n_days', 'specific_month', 'date_range'
             'days_ago': None,
@@ -174,41 +220,26 @@ class QueryAnalyzer:
             'end_date': None,
         }
         
-        # Проверяем маркеры времени
-        for marker, days in self.TIME_MARKERS.items():
-            if marker in self.query_text:
-                result['type'] = 'last_n_days'
-                result['days_ago'] = days
-                result['start_date'] = date.today() - timedelta(days=days)
-                result['end_date'] = date.today()
-                break
-        
-        # Проверяем конкретные месяцы
-        months_mapping = {
-            'январ': 1, 'феврал': 2, 'март': 3, 'апрел': 4,
-            'ма': 5, 'июн': 6, 'июл': 7, 'август': 8,
-            'сентябр': 9, 'октябр': 10, 'ноябр': 11, 'декабр': 12,
-            'january': 1, 'february': 2, 'march': 3, 'april': 4,
-            'may': 5, 'june': 6, 'july': 7, 'august': 8,
-            'september': 9, 'october': 10, 'november': 11, 'december': 12,
-            'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4,
-            'jun': 6, 'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12,
-        }
+        if time_marker:
+            days = QueryAnalyzer.TIME_MARKERS[time_marker]
+            result['type'] = 'last_n_days'
+            result['days_ago'] = days
+            result['start_date'] = date.today() - timedelta(days=days)
+            result['end_date'] = date.today()
         
-        for month_name, month_num in months_mapping.items():
-            if month_name in self.query_text:
-                result['type'] = 'specific_month'
-                # Определяем год (текущий или прошлый)
-                year = datetime.now().year
-                if 'прошл' in self.query_text:
-                    year -= 1
-                result['start_date'] = date(year, month_num, 1)
-                # Последний день месяца
-                if month_num == 12:
-                    result['end_date'] = date(year, 12, 31)
-                else:
-                    result['end_date'] = date(year, month_num + 1, 1) - timedelta(days=1)
-                break
+        if month:
+            month_num = QueryAnalyzer.MONTHS[month]
+            result['type'] = 'specific_month'
+            # Определяем год (текущий или прошлый)
+            year = datetime.now().year
+            if 'прошл' in text:
+                year -= 1
+            result['start_date'] = date(year, month_num, 1)
+            # Последний день месяца
+            if month_num == 12:
+                result['end_date'] = date(year, 12, 31)
+            else:
+                result['end_date'] = date(year, month_num + 1, 1) - timedelta(days=1)
         
         # Если ничего не найдено, берем последние 3 месяца
         if result['type'] is None:
@@ -219,17 +250,14 @@ class QueryAnalyzer:
         
         return result
     
-    def _extract_amounts(self) -> List[float]:
+    @staticmethod
+    def _extract_amounts(text: str) -> List[float]:
         """Извлекает числовые значения (суммы) из запроса"""
         # Ищем числа в тексте
         amounts = []
-        # Паттерн: число может быть с пробелами (1 000) или без (1000)
-        pattern = r'\b\d{1,3}(?:[\s,]\d{3})*(?:\.\d+)?\b'
-        matches = re.findall(pattern, self.query_text)
-        
-        for match in matches:
+        for match in _AMOUNT_RE.findall(text):
             # Убираем пробелы и запятые
-            clean = match.replace(' ', '').replace(',', '')
+            clean = match.translate(_AMOUNT_SEPARATORS)
             try:
                 amounts.append(float(clean))
             except ValueError:
@@ -237,28 +265,92 @@ class QueryAnalyzer:
         
         return amounts
     
-    def _get_context_priority(self, query_type: str) -> List[str]:
+    @staticmethod
+    def _get_context_priority(query_type: str) -> List[str]:
         """
         Определяет приоритет данных для контекста в зависимости от типа запроса.
         
         Returns:
             List в порядке приоритета: ['tables', 'trends', 'anomalies', 'goals', 'transactions']
         """
-        priorities = {
-            QueryType.TRENDS: ['trends', 'tables', 'anomalies'],
-            QueryType.ANOMALIES: ['anomalies', 'transactions', 'tables'],
-            QueryType.ADVICE: ['trends', 'anomalies', 'goals', 'tables'],
-            QueryType.COMPARISON: ['tables', 'trends'],
-            QueryType.FORECAST: ['trends', 'tables', 'goals'],
-            QueryType.SPECIFIC: ['transactions', 'tables'],
-            QueryType.GOALS: ['goals', 'trends', 'tables'],
-            QueryType.GENERAL: ['tables', 'trends', 'anomalies'],
-        }
+        # Копия — результат уходит вызывающему коду и может изменяться
+        return list(QueryAnalyzer.CONTEXT_PRIORITIES.get(query_type, ('tables', 'trends')))
+
+
+# Число может быть с пробелами (1 000) или без (1000)
+_AMOUNT_RE = re.compile(r'\b\d{1,3}(?:[\s,]\d{3})*(?:\.\d+)?\b')
+_AMOUNT_SEPARATORS = str.maketrans('', '', ' ,')
+
+
+_WORD_CHAR_RE = re.compile(r'\w')
+
+# Ключевое слово -> индекс типа в _QUERY_TYPES
+_KEYWORD_TYPE_IDS = {
+    keyword: _QUERY_TYPES.index(query_type)
+    for query_type, keywords in QueryAnalyzer.KEYWORDS.items()
+    for keyword in keywords
+}
+_CATEGORY_SET = frozenset(QueryAnalyzer.CATEGORY_KEYWORDS)
+
+# Один автомат на все виды меток: ключевые слова, категории, время, месяцы
+_MARKER_MATCHER = KeywordMatcher([
+    *_KEYWORD_TYPE_IDS, *QueryAnalyzer.CATEGORY_KEYWORDS,
+    *QueryAnalyzer.TIME_MARKERS, *QueryAnalyzer.MONTHS,
+])
+
+
+# Анализатор не хранит состояния, поэтому один экземпляр можно разделять между потоками
+_ANALYZER = QueryAnalyzer()
+
+
+@lru_cache(maxsize=1024)
+def _analyze_text(text: str) -> Tuple[str, Tuple[str, ...], Tuple[float, ...], Optional[str], Optional[str]]:
+    """
+    Не зависящая от даты часть анализа: тип запроса, категории, суммы,
+    первые упомянутые маркер времени и месяц.
+    Кэшируется по тексту — в чате одни и те же вопросы повторяются часто.
+    """
+    keyword_hits = set()
+    keyword_end = 0
+    category_hits = set()
+    time_marker = None
+    month = None
+    
+    # Один проход слева направо; в одной позиции длинные слова идут первыми
+    for start, word in _MARKER_MATCHER.matches(text):
+        # Ключевые слова типов не перекрываются: 'save up' (GOALS)
+        # не засчитывается ещё и как вложенное в него 'save' (ADVICE)
+        if start >= keyword_end and word in _KEYWORD_TYPE_IDS:
+            keyword_hits.add(word)
+            keyword_end = start + len(word)
+        if word in _CATEGORY_SET:
+            category_hits.add(word)
         
-        return priorities.get(query_type, ['tables', 'trends'])
+        # Время и месяц — первое упоминание с начала слова
+        if (time_marker is None or month is None) and (
+            start == 0 or not _WORD_CHAR_RE.match(text, start - 1)
+        ):
+            if time_marker is None and word in QueryAnalyzer.TIME_MARKERS:
+                time_marker = word
+            if month is None and word in QueryAnalyzer.MONTHS:
+                month = word
+    
+    return (
+        QueryAnalyzer._detect_query_type(keyword_hits),
+        tuple(QueryAnalyzer._extract_categories(category_hits)),
+        tuple(QueryAnalyzer._extract_amounts(text)),
+        time_marker,
+        month,
+    )
+
+
+def category_type_codes(categories: List[str]) -> List[str]:
+    """Переводит категории из запроса в коды типов транзакций (без повторов)"""
+    codes = (QueryAnalyzer.CATEGORY_TYPE_CODES.get(cat) for cat in categories)
+    return list(dict.fromkeys(code for code in codes if code))
 
 
-def analyze_query(query: str) -> Dict[str, Any]:
+def analyze_query(query: str) -> QueryAnalysis:
     """
     Удобная функция для анализа запроса.
     
@@ -268,5 +360,4 @@ def analyze_query(query: str) -> Dict[str, Any]:
     Returns:
         Результат анализа
     """
-    analyzer = QueryAnalyzer()
-    return analyzer.analyze(query)
+    return _ANALYZER.analyze(query)
@@ -0,0 +1,78 @@
+"""
+Кэш ответов AI для повторяющихся и почти одинаковых вопросов.
+Позволяет не вызывать LLM, если пользователь уже задавал такой вопрос
+при тех же данных.
+"""
+
+import difflib
+import hashlib
+import re
+from typing import Optional
+
+from django.core.cache import cache
+
+from core.ai.query_analyzer import QueryType
+
+
+# Типы запросов, ответ на которые определяется данными, а не творчеством модели
+CACHEABLE_QUERY_TYPES = {
+    QueryType.TRENDS,
+    QueryType.ANOMALIES,
+    QueryType.COMPARISON,
+    QueryType.FORECAST,
+    QueryType.SPECIFIC,
+}
+
+# Порог схожести нормализованных запросов (0-1)
+SIMILARITY_THRESHOLD = 0.95
+
+# Сколько вариантов вопросов хранить на один контекст
+MAX_ENTRIES = 20
+
+RESPONSE_CACHE_TIMEOUT = 3600
+
+_NON_WORD_RE = re.compile(r'[^\w\s]+')
+_SPACES_RE = re.compile(r'\s+')
+
+
+def normalize_query(query: str) -> str:
+    """Приводит запрос к нижнему регистру, убирает пунктуацию и лишние пробелы"""
+    text = _NON_WORD_RE.sub(' ', query.lower())
+    return _SPACES_RE.sub(' ', text).strip()
+
+
+def _cache_key(user_id, context: str) -> str:
+    # Хеш контекста меняется вместе с данными пользователя — старые ответы
+    # автоматически перестают находиться
+    ctx_hash = hashlib.blake2b(context.encode('utf-8'), digest_size=16).hexdigest()
+    return f"sem:{user_id}:{ctx_hash}"
+
+
+def get_cached_response(user_id, query: str, context: str) -> Optional[str]:
+    """Возвращает сохраненный ответ на такой же или почти такой же вопрос"""
+    entries = cache.get(_cache_key(user_id, context))
+    if not entries:
+        return None
+    
+    normalized = normalize_query(query)
+    for cached_query, response in entries:
+        if cached_query == normalized:
+            return response
+    
+    for cached_query, response in entries:
+        ratio = difflib.SequenceMatcher(None, cached_query, normalized).ratio()
+        if ratio >= SIMILARITY_THRESHOLD:
+            return response
+    
+    return None
+
+
+def store_response(user_id, query: str, context: str, response: str) -> None:
+    """Сохраняет ответ LLM (ответы с ошибками не кэшируются)"""
+    if not response or response.startswith('['):
+        return
+    
+    key = _cache_key(user_id, context)
+    entries = cache.get(key) or []
+    entries.append((normalize_query(query), response))
+    cache.set(key, entries[-MAX_ENTRIES:], RESPONSE_CACHE_TIMEOUT)
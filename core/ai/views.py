@@ -6,18 +6,17 @@
     path('api/ai/chat/v2/', views.ai_chat_api_v2, name='ai_chat_v2'),
 """
 
-from django.http import JsonResponse
+from django.http import StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
 from django.conf import settings
-import json
+import secrets
 import uuid
 
 from core.models import ChatSession, ChatMessage
-from core.ai.advisor import get_financial_advice
-from core.utils.analytics import parse_actionable_items
-from core.llm import _compute_content_hash
+from core.utils import fast_json
+from core.utils.fast_json import FastJsonResponse
 
 
 @csrf_exempt
@@ -32,27 +31,28 @@ def ai_chat_api_v2(request):
     - Умный подбор контекста на основе запроса
     - Персонализированный профиль пользователя
     - Группировка советов по приоритетам
+    - Потоковый ответ (SSE) при "stream": true в теле или ?stream=1
     """
     if request.method != 'POST':
-        return JsonResponse({'ok': False, 'error': 'POST only'}, status=405)
+        return FastJsonResponse({'ok': False, 'error': 'POST only'}, status=405)
     
     # Парсим запрос
-    try:
-        if request.content_type == 'application/json':
-            data = json.loads(request.body)
-        else:
+    if request.content_type == 'application/json':
+        try:
+            data = fast_json.loads(request.body)
+        except fast_json.JSONDecodeError:
             data = request.POST.dict()
-    except:
+    else:
         data = request.POST.dict()
     
     msg = data.get('message', '').strip()
     session_id = data.get('session_id')
     
     if not msg:
-        return JsonResponse({'ok': False, 'error': 'Пустое сообщение'}, status=400)
+        return FastJsonResponse({'ok': False, 'error': 'Пустое сообщение'}, status=400)
     
     if len(msg) > 5000:
-        return JsonResponse({
+        return FastJsonResponse({
             'ok': False, 
             'error': 'Сообщение слишком длинное (максимум 5000 символов)'
         }, status=400)
@@ -89,159 +89,241 @@ def ai_chat_api_v2(request):
             title=msg[:50] + ('...' if len(msg) > 50 else '')
     )
     
-    # Автоматически генерируем название если пустое
-    if not session.title:
+    # Автоматически генерируем название если пустое (сохраняется вместе с action_log)
+    title_changed = not session.title
+    if title_changed:
         session.title = msg[:50] + ('...' if len(msg) > 50 else '')
-        session.save()
+    
+    # Потоковый режим (SSE): заголовки уходят сразу, ответ — по готовности.
+    # В form-encoded запросе значения — строки, поэтому 'stream=0' не включает поток
+    if data.get('stream') in (True, '1', 'true') or request.GET.get('stream') == '1':
+        response = StreamingHttpResponse(
+            _stream_chat_events(request, session, session_id, msg, use_local, anonymize, title_changed),
+            content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
     
     try:
-        # 1. Сохраняем сообщение пользователя
-        ChatMessage.objects.create(
+        return FastJsonResponse(
+            _process_chat_message(request, session, session_id, msg, use_local, anonymize, title_changed)
+        )
+    except Exception as ex:
+        return FastJsonResponse(_error_payload(ex), status=500)
+
+
+def _process_chat_message(request, session, session_id, msg, use_local, anonymize, title_changed) -> dict:
+    """Получает ответ советника, сохраняет сообщения и action_log, собирает payload ответа"""
+    # LLM-модули тяжелые — импортируем при первом запросе, а не при загрузке urls
+    from core.ai.advisor import get_financial_advice
+    
+    # 1. ИСПОЛЬЗУЕМ НОВЫЙ УЛУЧШЕННЫЙ СОВЕТНИК
+    # (текущий вопрос советник добавляет к истории сам, поэтому
+    # сообщение пользователя сохраняется вместе с ответом ниже)
+    result = get_financial_advice(
+        user=request.user,
+        query=msg,
+        session=session,
+        use_local=use_local,
+        anonymize=anonymize
+    )
+    
+    return _save_chat_result(session, session_id, msg, use_local, anonymize, title_changed, result)
+
+
+def _save_chat_result(session, session_id, msg, use_local, anonymize, title_changed, result) -> dict:
+    """Сохраняет вопрос, ответ советника и action_log, собирает payload ответа"""
+    from core.utils.analytics import parse_actionable_items
+    from core.llm import _compute_content_hash, _extract_advice_snippets
+    
+    reply = result['response']
+    query_type = result.get('query_type', 'general')
+    context_used = result.get('context_used', {})
+    metadata = result.get('metadata', {})
+    
+    # 2. Сохраняем вопрос и ответ одним INSERT (created_at проставляется по порядку)
+    ChatMessage.objects.bulk_create([
+        ChatMessage(
             session=session,
             role='user',
             content=msg,
             content_hash=_compute_content_hash(msg)
-        )
+        ),
+        ChatMessage(
+            session=session,
+            role='assistant',
+            content=reply,
+            content_hash=_compute_content_hash(reply),
+            advice_snippets=_extract_advice_snippets(reply)
+        ),
+    ])
+    
+    # Извлекаем actionable советы
+    actionable_items = parse_actionable_items(reply)
+    
+    # Группируем по секциям и приоритетам
+    advice_by_section = {
+        'now': [],
+        'this_month': [],
+        'future': [],
+        'urgent': [],
+        'quick_win': [],
+        'long_term': [],
+        'general': [],
+    }
+    
+    for item in actionable_items:
+        section = item.get('section', 'general')
+        priority = item.get('priority', 'normal')
+    
+        # Группировка по секции
+        in_section = section in advice_by_section
+        if in_section:
+            advice_by_section[section].append(item)
+    
+        # Группировка по приоритету (если он совпадает с секцией, совет уже добавлен),
+        # иначе — fallback в general
+        if priority != section and priority in advice_by_section:
+            advice_by_section[priority].append(item)
+        elif not in_section:
+            advice_by_section['general'].append(item)
+    
+    # Обновляем action_log (одна метка времени на весь запрос)
+    now_iso = timezone.now().isoformat()
+    try:
+        # Изменяем JSON сессии на месте — он целиком сериализуется при save()
+        action_log = session.action_log or {}
+        action_log['advices_given'] = action_log.get('advices_given', 0) + len(actionable_items)
+        action_log['last_advice_at'] = now_iso
+        action_log['total_messages'] = action_log.get('total_messages', 0) + 1
+        action_log['query_types'] = action_log.get('query_types', [])
+        action_log['query_types'].append({
+            'type': query_type,
+            'timestamp': now_iso
+        })
+    
+        # Сохраняем все советы с новыми полями
+        if 'all_advices' not in action_log:
+            action_log['all_advices'] = []
+    
+        for item in actionable_items:
+            advice_id = secrets.token_hex(4)
+            action_log['all_advices'].append({
+                'id': advice_id,
+                'text': item.get('text', ''),
+                'type': item.get('type', 'unknown'),
+                'section': item.get('section', 'general'),
+                'priority': item.get('priority', 'normal'),
+                'query_type': query_type,  # Новое поле
+                'created_at': now_iso,
+                'completed': False,
+            })
+    
+        session.action_log = action_log
+        update_fields = ['action_log', 'updated_at']
+        if title_changed:
+            update_fields.append('title')
+        session.save(update_fields=update_fields)
+    except Exception as e:
+        print(f"Ошибка обновления action_log: {e}")
+    
+    # Получаем активные советы
+    active_advices = []
+    try:
+        all_advices = action_log.get('all_advices', [])
+        active_advices = [a for a in all_advices if not a.get('completed', False)]
+    except:
+        pass
+    
+    return {
+        'ok': True,
+        'reply': reply,
+        'session_id': session_id,
+        'used_local': use_local,
+        'anonymize': anonymize,
+    
+        # Метаданные анализа
+        'query_type': query_type,
+        'context_used': context_used,
+        'metadata': metadata,
+    
+        # Actionable советы
+        'actionable_items': actionable_items,
+        'actionable_by_section': advice_by_section,
+        'actionable_count': len(actionable_items),
+    
+        # Активные советы из сессии
+        'active_advices': active_advices,
+        'active_advices_count': len(active_advices),
+    
+        # Статистика сессии
+        'session_stats': {
+            'total_messages': action_log.get('total_messages', 0),
+            'advices_given': action_log.get('advices_given', 0),
+            'advices_completed': action_log.get('advices_completed', 0),
+        },
+    
+        # Версия API
+        'api_version': 'v2',
+        'enhanced': True,
+    }
+
+
+def _error_payload(ex: Exception) -> dict:
+    """Формирует ответ об ошибке (с traceback в DEBUG)"""
+    import traceback
+    error_trace = traceback.format_exc()
+    print(f"Ошибка в ai_chat_api_v2: {ex}")
+    print(error_trace)
+    
+    response_data = {
+        'ok': False,
+        'error': f'Ошибка обработки запроса: {str(ex)}'
+    }
+    
+    if settings.DEBUG:
+        response_data['traceback'] = error_trace
+    
+    return response_data
 
-        # 2. ИСПОЛЬЗУЕМ НОВЫЙ УЛУЧШЕННЫЙ СОВЕТНИК
-        result = get_financial_advice(
+
+def _sse_event(payload: dict) -> str:
+    """Кадр Server-Sent Events"""
+    return "data: " + fast_json.dumps(payload).decode() + "\n\n"
+
+
+def _stream_chat_events(request, session, session_id, msg, use_local, anonymize, title_changed):
+    """
+    Поток событий для ai_chat_api_v2:
+    session (сразу) → delta (фрагменты ответа по мере генерации) →
+    reply (полный текст ответа) → done (метаданные и советы).
+    При ошибке (в т.ч. обрыве ответа LLM) — событие error, и ничего не сохраняется.
+    """
+    from core.ai.advisor import stream_financial_advice
+    
+    yield _sse_event({'type': 'session', 'session_id': session_id})
+    
+    try:
+        advice = stream_financial_advice(
             user=request.user,
             query=msg,
             session=session,
             use_local=use_local,
             anonymize=anonymize
         )
+        while True:
+            try:
+                delta = next(advice)
+            except StopIteration as stop:
+                result = stop.value
+                break
+            yield _sse_event({'type': 'delta', 'content': delta})
         
-        reply = result['response']
-        query_type = result.get('query_type', 'general')
-        context_used = result.get('context_used', {})
-        metadata = result.get('metadata', {})
-        
-        # 3. Сохраняем сообщение ассистента
-        assistant_msg = ChatMessage.objects.create(
-            session=session,
-            role='assistant',
-            content=reply,
-            content_hash=_compute_content_hash(reply)
-        )
-        
-        # Извлекаем actionable советы
-        actionable_items = parse_actionable_items(reply)
-        
-        # Группируем по секциям и приоритетам
-        advice_by_section = {
-            'now': [],
-            'this_month': [],
-            'future': [],
-            'urgent': [],
-            'quick_win': [],
-            'long_term': [],
-            'general': [],
-        }
-        
-        for item in actionable_items:
-            section = item.get('section', 'general')
-            priority = item.get('priority', 'normal')
-            
-            # Группировка по секции
-            if section in advice_by_section:
-                advice_by_section[section].append(item)
-            
-            # Группировка по приоритету
-            if priority in advice_by_section:
-                advice_by_section[priority].append(item)
-            
-            # Fallback в general
-            if section not in advice_by_section and priority not in advice_by_section:
-                advice_by_section['general'].append(item)
-        
-        # Обновляем action_log
-        try:
-            action_log = dict(session.action_log or {})
-            action_log['advices_given'] = action_log.get('advices_given', 0) + len(actionable_items)
-            action_log['last_advice_at'] = timezone.now().isoformat()
-            action_log['total_messages'] = action_log.get('total_messages', 0) + 1
-            action_log['query_types'] = action_log.get('query_types', [])
-            action_log['query_types'].append({
-                'type': query_type,
-                'timestamp': timezone.now().isoformat()
-            })
-            
-            # Сохраняем все советы с новыми полями
-            if 'all_advices' not in action_log:
-                action_log['all_advices'] = []
-            
-            for item in actionable_items:
-                advice_id = str(uuid.uuid4())[:8]
-                action_log['all_advices'].append({
-                    'id': advice_id,
-                    'text': item.get('text', ''),
-                    'type': item.get('type', 'unknown'),
-                    'section': item.get('section', 'general'),
-                    'priority': item.get('priority', 'normal'),
-                    'query_type': query_type,  # Новое поле
-                    'created_at': timezone.now().isoformat(),
-                    'completed': False,
-                })
-            
-            session.action_log = action_log
-            session.save()
-        except Exception as e:
-            print(f"Ошибка обновления action_log: {e}")
-        
-        # Получаем активные советы
-        active_advices = []
-        try:
-            all_advices = action_log.get('all_advices', [])
-            active_advices = [a for a in all_advices if not a.get('completed', False)]
-        except:
-            pass
-        
-        return JsonResponse({
-            'ok': True,
-            'reply': reply,
-            'session_id': session_id,
-            'used_local': use_local,
-            'anonymize': anonymize,
-            
-            # Метаданные анализа
-            'query_type': query_type,
-            'context_used': context_used,
-            'metadata': metadata,
-            
-            # Actionable советы
-            'actionable_items': actionable_items,
-            'actionable_by_section': advice_by_section,
-            'actionable_count': len(actionable_items),
-            
-            # Активные советы из сессии
-            'active_advices': active_advices,
-            'active_advices_count': len(active_advices),
-            
-            # Статистика сессии
-            'session_stats': {
-                'total_messages': action_log.get('total_messages', 0),
-                'advices_given': action_log.get('advices_given', 0),
-                'advices_completed': action_log.get('advices_completed', 0),
-            },
-            
-            # Версия API
-            'api_version': 'v2',
-            'enhanced': True,
-        })
-        
+        payload = _save_chat_result(session, session_id, msg, use_local, anonymize, title_changed, result)
     except Exception as ex:
-        import traceback
-        error_trace = traceback.format_exc()
-        print(f"Ошибка в ai_chat_api_v2: {ex}")
-        print(error_trace)
-        
-        response_data = {
-            'ok': False,
-            'error': f'Ошибка обработки запроса: {str(ex)}'
-        }
-        
-        if settings.DEBUG:
-            response_data['traceback'] = error_trace
-        
-        return JsonResponse(response_data, status=500)
+        yield _sse_event({'type': 'error', **_error_payload(ex)})
+        return
+    
+    yield _sse_event({'type': 'reply', 'content': payload.pop('reply')})
+    yield _sse_event({'type': 'done', **payload})
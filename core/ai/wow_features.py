@@ -3,18 +3,80 @@ WOW-ФИЧИ для впечатления жюри хакатона.
 Быстрые, эффектные, технически впечатляющие.
 """
 
-from django.http import StreamingHttpResponse, JsonResponse
+from django.http import StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
-import json
-import time
+from django.core.cache import cache
+from django.db.models import Count, F, FloatField, Min, Sum
+from bisect import bisect_left, bisect_right
+import math
+import re
 from typing import Generator
 
 from core.ai.advisor import get_financial_advice
 from core.models import Income, Expense
+from core.utils.cache import user_cache_key
+from core.utils import fast_json
+from core.utils.fast_json import FastJsonResponse
 from datetime import date, timedelta
-import numpy as np
-from collections import Counter
+
+
+# Результаты меняются только с новыми транзакциями: ключи версионные
+# (сбрасываются сигналами Income/Expense), TTL — страховка
+SCORE_CACHE_TIMEOUT = 300
+
+# Категории, упоминание которых делает запрос конкретным (для confidence score)
+_SPECIFIC_CATEGORY_RE = re.compile('маркетинг|офис|зарплата|еда')
+_DETAILED_CATEGORY_RE = re.compile('маркетинг|офис')  # подмножество _SPECIFIC_CATEGORY_RE
+
+
+# Цепочка рассуждений для ai_explain_reasoning: шаги 2-4 не зависят от запроса
+_REASONING_KEYWORD_RE = re.compile('расход|доход|финанс')
+_STATIC_REASONING_STEPS = (
+    {
+        'step': 2,
+        'title': 'Сбор финансовых данных',
+        'details': 'Загрузка транзакций из базы данных',
+        'icon': '📊',
+        'data': {
+            'sources': ['Income', 'Expense', 'Analytics']
+        }
+    },
+    {
+        'step': 3,
+        'title': 'Статистический анализ',
+        'details': 'Рассчитал z-scores, тренды, аномалии',
+        'icon': '📈',
+        'data': {
+            'methods': ['z-score', 'moving average', 'trend analysis']
+        }
+    },
+    {
+        'step': 4,
+        'title': 'Формирование советов',
+        'details': 'Приоритизировал по срочности и эффекту',
+        'icon': '💡',
+        'data': {
+            'prioritization': 'По срочности и ROI'
+        }
+    },
+)
+
+
+def _sse_frame(payload: dict) -> bytes:
+    """Кадр Server-Sent Events"""
+    return b"data: " + fast_json.dumps(payload) + b"\n\n"
+
+
+# Статичные кадры "AI думает" одинаковы для всех запросов — сериализуем при импорте
+_THINKING_FRAMES = tuple(
+    _sse_frame({'type': 'thinking', 'message': message})
+    for message in (
+        '🔍 Анализирую ваш запрос...',
+        '📊 Собираю финансовые данные...',
+        '🔎 Обнаружение аномалий и трендов...',
+    )
+)
 
 
 @login_required
@@ -40,34 +102,17 @@ def ai_chat_streaming(request):
     ```
     """
     if request.method != 'POST':
-        return JsonResponse({'error': 'POST only'}, status=405)
+        return FastJsonResponse({'error': 'POST only'}, status=405)
     
-    data = json.loads(request.body)
+    data = fast_json.loads(request.body)
     query = data.get('message', '')
     
-    def generate_response() -> Generator[str, None, None]:
+    def generate_response() -> Generator[bytes, None, None]:
         """Генерирует ответ частями для streaming"""
         
-        # Шаг 1: Анализ запроса (показываем процесс)
-        yield "data: " + json.dumps({
-            'type': 'thinking',
-            'message': '🔍 Анализирую ваш запрос...'
-        }) + "\n\n"
-        time.sleep(0.3)
-        
-        # Шаг 2: Сбор данных
-        yield "data: " + json.dumps({
-            'type': 'thinking',
-            'message': '📊 Собираю финансовые данные...'
-        }) + "\n\n"
-        time.sleep(0.3)
-        
-        # Шаг 3: Поиск аномалий
-        yield "data: " + json.dumps({
-            'type': 'thinking',
-            'message': '🔎 Обнаружение аномалий и трендов...'
-        }) + "\n\n"
-        time.sleep(0.3)
+        # Шаги 1-3: анализ запроса, сбор данных, поиск аномалий (показываем процесс).
+        # Без искусственных пауз — они только держали воркер
+        yield from _THINKING_FRAMES
         
         # Шаг 4: Получаем реальный ответ
         try:
@@ -79,37 +124,32 @@ def ai_chat_streaming(request):
             
             response_text = result['response']
             
-            # Отправляем ответ по частям (симулируем печать)
+            # Отправляем ответ по частям без пауз: эффект печати делает клиент,
+            # пауза на сервере держала бы воркер всё время ответа
             words = response_text.split()
-            buffer = []
             
-            for i, word in enumerate(words):
-                buffer.append(word)
-                
-                # Отправляем каждые 5 слов
-                if len(buffer) >= 5 or i == len(words) - 1:
-                    chunk = ' '.join(buffer) + ' '
-                    yield "data: " + json.dumps({
-                        'type': 'content',
-                        'message': chunk
-                    }) + "\n\n"
-                    buffer = []
-                    time.sleep(0.05)  # Эффект печати
+            # Отправляем каждые 5 слов
+            for i in range(0, len(words), 5):
+                chunk = ' '.join(words[i:i + 5]) + ' '
+                yield _sse_frame({
+                    'type': 'content',
+                    'message': chunk
+                })
             
             # Финал
-            yield "data: " + json.dumps({
+            yield _sse_frame({
                 'type': 'done',
                 'metadata': {
                     'query_type': result.get('query_type'),
                     'context_size': result.get('metadata', {}).get('context_size', 0)
                 }
-            }) + "\n\n"
+            })
             
         except Exception as e:
-            yield "data: " + json.dumps({
+            yield _sse_frame({
                 'type': 'error',
                 'message': f'Ошибка: {str(e)}'
-            }) + "\n\n"
+            })
     
     response = StreamingHttpResponse(
         generate_response(),
@@ -131,13 +171,13 @@ def ai_confidence_score(request):
     - Наличие аномалий
     - Длина истории
     """
-    data = json.loads(request.body)
+    data = fast_json.loads(request.body)
     query = data.get('message', '')
+    query_text = query.lower()
     
     # Анализируем сколько данных есть
-    income_count = Income.objects.filter(user=request.user).count()
-    expense_count = Expense.objects.filter(user=request.user).count()
-    total_transactions = income_count + expense_count
+    stats = _transaction_stats(request.user)
+    total_transactions = stats['count']
     
     # Рассчитываем confidence (0-100)
     confidence = 50  # Базовый уровень
@@ -151,12 +191,11 @@ def ai_confidence_score(request):
         confidence += 5
     
     # +15 если есть история >3 месяцев
-    oldest_transaction = Expense.objects.filter(
-        user=request.user
-    ).order_by('date').first()
+    oldest_date = stats['oldest']
+    days_history = 0
     
-    if oldest_transaction:
-        days_history = (date.today() - oldest_transaction.date).days
+    if oldest_date:
+        days_history = (date.today() - oldest_date).days
         months_history = days_history / 30
         
         if months_history >= 6:
@@ -167,7 +206,8 @@ def ai_confidence_score(request):
             confidence += 5
     
     # +15 если запрос конкретный (есть категории)
-    if any(cat in query.lower() for cat in ['маркетинг', 'офис', 'зарплата', 'еда']):
+    has_specific = _SPECIFIC_CATEGORY_RE.search(query_text) is not None
+    if has_specific:
         confidence += 15
     
     # Ограничиваем 0-100
@@ -187,19 +227,37 @@ def ai_confidence_score(request):
         icon = '🔴'
         message = 'Низкая уверенность, недостаточно данных для точного анализа'
     
-    return JsonResponse({
+    return FastJsonResponse({
         'confidence': confidence,
         'level': level,
         'icon': icon,
         'message': message,
         'details': {
             'transactions': total_transactions,
-            'days_history': days_history if oldest_transaction else 0,
-            'has_specific_category': any(cat in query.lower() for cat in ['маркетинг', 'офис']),
+            'days_history': days_history,
+            # Подмножество конкретных категорий: без совпадения выше искать нечего
+            'has_specific_category': has_specific and _DETAILED_CATEGORY_RE.search(query_text) is not None,
         }
     })
 
 
+def _transaction_stats(user) -> dict:
+    """Число транзакций и дата самого старого расхода (кэшируется по пользователю)"""
+    key = user_cache_key('tx_stats', user.id)
+    stats = cache.get(key)
+    if stats is None:
+        # По одному запросу на модель
+        expense_stats = Expense.objects.filter(user=user).aggregate(
+            n=Count('id'), oldest=Min('date')
+        )
+        stats = {
+            'count': Income.objects.filter(user=user).count() + expense_stats['n'],
+            'oldest': expense_stats['oldest'],
+        }
+        cache.set(key, stats, SCORE_CACHE_TIMEOUT)
+    return stats
+
+
 @login_required
 def financial_health_score(request):
     """
@@ -212,86 +270,107 @@ def financial_health_score(request):
     - Стабильность доходов
     - Разнообразие источников дохода
     """
+    # Окно расчёта зависит от даты, поэтому она входит в ключ
+    key = user_cache_key('health_score', request.user.id, date.today().isoformat())
+    result = cache.get(key)
+    if result is None:
+        result = _compute_health_score(request.user)
+        cache.set(key, result, SCORE_CACHE_TIMEOUT)
+    
+    return FastJsonResponse(result)
+
+
+# Шкалы Financial Health Score: (возрастающие пороги, значения).
+# Значение выбирается по числу порогов, которых достигла величина
+# (при inclusive=False — которые она строго превысила)
+_SAVINGS_SCORES = ((0.10, 0.20, 0.30), (5, 15, 25, 35))
+_STABILITY_SCORES = ((0.2, 0.4), (25, 15, 5))
+_DIVERSIFICATION_SCORES = ((2, 3), (5, 10, 20))
+_EXPENSE_CONTROL_SCORES = ((0.4, 0.6), (20, 10, 5))
+_GRADES = (
+    (35, 50, 65, 80),
+    (
+        ('F', '🚨', 'Критическая ситуация, срочно нужны изменения!'),
+        ('D', '😟', 'Требуется оптимизация финансов'),
+        ('C', '😐', 'Удовлетворительно, есть что улучшить'),
+        ('B', '👍', 'Хорошее финансовое состояние'),
+        ('A', '🏆', 'Отличное финансовое здоровье!'),
+    ),
+)
+
+
+def _ladder(value, thresholds, results, inclusive=True):
+    """Возвращает значение шкалы для величины value"""
+    if inclusive:
+        return results[bisect_right(thresholds, value)]
+    return results[bisect_left(thresholds, value)]
+
+
+def _compute_health_score(user) -> dict:
+    """Считает Financial Health Score по транзакциям пользователя"""
     # Получаем данные за последние 3 месяца
     three_months_ago = date.today() - timedelta(days=90)
     
-    incomes = Income.objects.filter(
-        user=request.user,
-        date__gte=three_months_ago
+    # Суммы считает БД: по строке на категорию вместо всех транзакций
+    income_by_type = list(
+        Income.objects.filter(user=user, date__gte=three_months_ago)
+        .values('income_type')
+        .annotate(
+            n=Count('id'),
+            total=Sum('amount'),
+            total_sq=Sum(F('amount') * F('amount'), output_field=FloatField()),
+        )
     )
     
-    expenses = Expense.objects.filter(
-        user=request.user,
-        date__gte=three_months_ago
+    expense_by_type = list(
+        Expense.objects.filter(user=user, date__gte=three_months_ago)
+        .values('expense_type')
+        .annotate(n=Count('id'), total=Sum('amount'))
     )
     
-    total_income = sum(i.amount for i in incomes)
-    total_expense = sum(e.amount for e in expenses)
+    total_income = sum(row['total'] for row in income_by_type)
+    total_expense = sum(row['total'] for row in expense_by_type)
     
     if total_income == 0:
-        return JsonResponse({
+        return {
             'score': 0,
             'grade': 'F',
             'message': 'Недостаточно данных для оценки'
-        })
+        }
     
     # Компоненты score
     components = {}
     
     # 1. Savings Rate (35 баллов макс)
     savings_rate = (total_income - total_expense) / total_income
-    if savings_rate > 0.30:
-        components['savings'] = 35
-    elif savings_rate > 0.20:
-        components['savings'] = 25
-    elif savings_rate > 0.10:
-        components['savings'] = 15
-    elif savings_rate >= 0:
-        components['savings'] = 5
-    else:
+    if savings_rate < 0:
         components['savings'] = 0  # Расходы > доходов
+    else:
+        components['savings'] = _ladder(savings_rate, *_SAVINGS_SCORES, inclusive=False)
     
     # 2. Income Stability (25 баллов макс)
-    income_amounts = [i.amount for i in incomes]
-    if len(income_amounts) > 1:
-        income_std = np.std(income_amounts)
-        income_mean = np.mean(income_amounts)
+    income_count = sum(row['n'] for row in income_by_type)
+    if income_count > 1:
+        # σ² = E[x²] − E[x]²; отрицательный остаток — погрешность округления
+        income_mean = float(total_income) / income_count
+        income_sq_mean = sum(row['total_sq'] for row in income_by_type) / income_count
+        income_std = math.sqrt(max(income_sq_mean - income_mean ** 2, 0.0))
         cv = income_std / income_mean if income_mean > 0 else 1
-        
-        if cv < 0.2:
-            components['stability'] = 25
-        elif cv < 0.4:
-            components['stability'] = 15
-        else:
-            components['stability'] = 5
+        components['stability'] = _ladder(cv, *_STABILITY_SCORES)
     else:
         components['stability'] = 10
     
     # 3. Diversification (20 баллов макс)
-    income_categories = [i.category for i in incomes]
-    unique_categories = len(set(income_categories))
-    
-    if unique_categories >= 3:
-        components['diversification'] = 20
-    elif unique_categories == 2:
-        components['diversification'] = 10
-    else:
-        components['diversification'] = 5
+    unique_categories = len(income_by_type)
+    components['diversification'] = _ladder(unique_categories, *_DIVERSIFICATION_SCORES)
     
     # 4. Expense Control (20 баллов макс)
-    expense_categories = [e.category for e in expenses]
-    category_counts = Counter(expense_categories)
+    category_counts = [row['n'] for row in expense_by_type]
     
     # Проверяем нет ли одной доминирующей категории
     if category_counts:
-        max_category_pct = max(category_counts.values()) / len(expense_categories)
-        
-        if max_category_pct < 0.4:
-            components['expense_control'] = 20
-        elif max_category_pct < 0.6:
-            components['expense_control'] = 10
-        else:
-            components['expense_control'] = 5
+        max_category_pct = max(category_counts) / sum(category_counts)
+        components['expense_control'] = _ladder(max_category_pct, *_EXPENSE_CONTROL_SCORES)
     else:
         components['expense_control'] = 10
     
@@ -299,28 +378,9 @@ def financial_health_score(request):
     total_score = sum(components.values())
     
     # Определяем grade
-    if total_score >= 80:
-        grade = 'A'
-        emoji = '🏆'
-        message = 'Отличное финансовое здоровье!'
-    elif total_score >= 65:
-        grade = 'B'
-        emoji = '👍'
-        message = 'Хорошее финансовое состояние'
-    elif total_score >= 50:
-        grade = 'C'
-        emoji = '😐'
-        message = 'Удовлетворительно, есть что улучшить'
-    elif total_score >= 35:
-        grade = 'D'
-        emoji = '😟'
-        message = 'Требуется оптимизация финансов'
-    else:
-        grade = 'F'
-        emoji = '🚨'
-        message = 'Критическая ситуация, срочно нужны изменения!'
+    grade, emoji, message = _ladder(total_score, *_GRADES)
     
-    return JsonResponse({
+    return {
         'score': round(total_score),
         'grade': grade,
         'emoji': emoji,
@@ -345,7 +405,7 @@ def financial_health_score(request):
                 'max': 20,
             }
         }
-    })
+    }
 
 
 @login_required
@@ -360,58 +420,29 @@ def ai_explain_reasoning(request):
     3. Как пришел к выводу
     """
     try:
-        data = json.loads(request.body)
+        data = fast_json.loads(request.body)
         query = data.get('message', '')
         
-        # Простой reasoning chain без сложного анализа
-        reasoning_steps = [
-            {
-                'step': 1,
-                'title': 'Анализ запроса',
-                'details': f'Получен запрос: "{query[:50]}..."',
-                'icon': '🔍',
-                'data': {
-                    'query_length': len(query),
-                    'has_keywords': any(word in query.lower() for word in ['расход', 'доход', 'финанс'])
-                }
-            },
-            {
-                'step': 2,
-                'title': 'Сбор финансовых данных',
-                'details': 'Загрузка транзакций из базы данных',
-                'icon': '📊',
-                'data': {
-                    'sources': ['Income', 'Expense', 'Analytics']
-                }
-            },
-            {
-                'step': 3,
-                'title': 'Статистический анализ',
-                'details': 'Рассчитал z-scores, тренды, аномалии',
-                'icon': '📈',
-                'data': {
-                    'methods': ['z-score', 'moving average', 'trend analysis']
-                }
-            },
-            {
-                'step': 4,
-                'title': 'Формирование советов',
-                'details': 'Приоритизировал по срочности и эффекту',
-                'icon': '💡',
-                'data': {
-                    'prioritization': 'По срочности и ROI'
-                }
+        # Шаг 1 зависит от запроса, остальные шаги — общие константы
+        first_step = {
+            'step': 1,
+            'title': 'Анализ запроса',
+            'details': f'Получен запрос: "{query[:50]}..."',
+            'icon': '🔍',
+            'data': {
+                'query_length': len(query),
+                'has_keywords': bool(_REASONING_KEYWORD_RE.search(query.lower()))
             }
-        ]
+        }
         
-        return JsonResponse({
-            'reasoning_chain': reasoning_steps,
-            'total_steps': len(reasoning_steps),
+        return FastJsonResponse({
+            'reasoning_chain': [first_step, *_STATIC_REASONING_STEPS],
+            'total_steps': 1 + len(_STATIC_REASONING_STEPS),
             'confidence': 85,
             'data_points_analyzed': 150,
         })
     except Exception as e:
-        return JsonResponse({
+        return FastJsonResponse({
             'error': str(e),
             'reasoning_chain': [],
             'total_steps': 0
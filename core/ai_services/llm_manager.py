@@ -6,15 +6,34 @@ Handles multiple LLM providers with consistent interface
 import json
 import logging
 import asyncio
+import threading
+from types import MappingProxyType
 from typing import Dict, List, Any, Optional, Union
 from dataclasses import dataclass
 from enum import Enum
 
 import requests
+from asgiref.sync import sync_to_async
 from django.conf import settings
 
+from core.utils import fast_json
+
 logger = logging.getLogger(__name__)
 
+# Shared session with keep-alive connection pools: no new TCP+TLS handshake per call
+_http = requests.Session()
+_http.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=20))
+_http.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=20))
+
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+
+def _post_json(url: str, payload: Dict, headers: Dict[str, str], timeout: int):
+    """POST a JSON payload (serialized with orjson when available) and decode the JSON reply"""
+    response = _http.post(url, data=fast_json.dumps(payload), headers=headers, timeout=timeout)
+    response.raise_for_status()
+    return fast_json.loads(response.content)
+
 
 class LLMProvider(Enum):
     OPENAI = "openai"
@@ -24,6 +43,68 @@ class LLMProvider(Enum):
     DEEPSEEK = "deepseek"
 
 
+PROVIDER_URLS = MappingProxyType({
+    LLMProvider.OPENAI: 'https://api.openai.com/v1',
+    LLMProvider.ANTHROPIC: 'https://api.anthropic.com/v1',
+    LLMProvider.OPENROUTER: 'https://openrouter.ai/api/v1',
+    LLMProvider.OLLAMA: 'http://localhost:11434/api',
+    LLMProvider.DEEPSEEK: 'https://api.deepseek.com/v1',
+})
+
+DEFAULT_MODELS = MappingProxyType({
+    LLMProvider.OPENAI: 'gpt-4o-mini',
+    LLMProvider.ANTHROPIC: 'claude-3-haiku-20240307',
+    LLMProvider.OPENROUTER: 'openai/gpt-4o-mini',
+    LLMProvider.OLLAMA: 'llama2',
+    LLMProvider.DEEPSEEK: 'deepseek-chat',
+})
+
+
+# Base teen coach prompts (independent of the user)
+TEEN_CONTEXT_PROMPTS = MappingProxyType({
+    'ru': """
+Ты - дружелюбный финансовый коуч для подростков 13-18 лет. 
+Говори простым языком, понятным школьнику.
+Используй примеры из жизни подростков (школа, карманные деньги, покупка телефона, экономия на развлечениях).
+Будь позитивным и мотивирующим, но реалистичным.
+Всегда объясняй "почему" свои рекомендации простыми словами.
+
+Избегай:
+- Сложных финансовых терминов
+- Банковских деталей (кредиты, ипотека)
+- Взрослых примеров (семья, работа полный день)
+- Морализаторства
+
+Помогай:
+- Планировать покупки (телефон, курсы, одежда)
+- Экономить на развлечениях
+- Понимать ценность денег
+- Ставить реальные цели
+- Объяснять инфляцию простыми словами
+""",
+    'en': """
+You are a friendly financial coach for teenagers aged 13-18.
+Speak in simple language that a high school student can understand.
+Use examples from teen life (school, allowance, phone purchases, saving on entertainment).
+Be positive and motivating, but realistic.
+Always explain "why" your recommendations in simple terms.
+
+Avoid:
+- Complex financial terminology
+- Banking details (loans, mortgages)
+- Adult examples (family, full-time job)
+- Preaching
+
+Help with:
+- Planning purchases (phone, courses, clothes)
+- Saving on entertainment
+- Understanding the value of money
+- Setting realistic goals
+- Explaining inflation in simple terms
+""",
+})
+
+
 @dataclass
 class LLMResponse:
     """Standardized response from any LLM provider"""
@@ -52,6 +133,14 @@ class LLMManager:
         }
         self.current_provider = self._detect_provider()
         
+        # Provider config does not change between calls, so resolve it once
+        self.base_url = PROVIDER_URLS[self.current_provider]
+        self.model = getattr(settings, 'LLM_MODEL', DEFAULT_MODELS[self.current_provider])
+        self.headers = self._build_headers()
+        
+        # Limit concurrent provider calls (sync and async) to avoid rate-limit storms
+        self._call_slots = threading.BoundedSemaphore(getattr(settings, 'LLM_CONCURRENCY', 8))
+        
     def _detect_provider(self) -> LLMProvider:
         """Detect available LLM provider based on settings"""
         api_key = getattr(settings, 'LLM_API_KEY', None)
@@ -71,8 +160,8 @@ class LLMManager:
             logger.warning(f"No valid LLM provider found, using OpenRouter")
             return LLMProvider.OPENROUTER
     
-    def _get_headers(self) -> Dict[str, str]:
-        """Get headers for API requests"""
+    def _build_headers(self) -> Dict[str, str]:
+        """Build headers for API requests of the current provider"""
         headers = {
             'Content-Type': 'application/json',
             'User-Agent': 'SB-Finance-AI-Teen/1.0'
@@ -81,31 +170,18 @@ class LLMManager:
         api_key = getattr(settings, 'LLM_API_KEY', None)
         if api_key:
             headers['Authorization'] = f"Bearer {api_key}"
+        
+        # Provider specific headers
+        if self.current_provider == LLMProvider.OPENROUTER:
+            headers.update({
+                'HTTP-Referer': getattr(settings, 'LLM_HTTP_REFERER', 'http://localhost:8000'),
+                'X-Title': 'SB Finance AI - Teen Platform'
+            })
+        elif self.current_provider == LLMProvider.ANTHROPIC:
+            headers['anthropic-version'] = '2023-06-01'
             
         return headers
     
-    def _get_base_url(self) -> str:
-        """Get base URL for current provider"""
-        urls = {
-            LLMProvider.OPENAI: 'https://api.openai.com/v1',
-            LLMProvider.ANTHROPIC: 'https://api.anthropic.com/v1',
-            LLMProvider.OPENROUTER: 'https://openrouter.ai/api/v1',
-            LLMProvider.OLLAMA: 'http://localhost:11434/api',
-            LLMProvider.DEEPSEEK: 'https://api.deepseek.com/v1',
-        }
-        return urls[self.current_provider]
-    
-    def _get_model(self) -> str:
-        """Get model name for current provider"""
-        models = {
-            LLMProvider.OPENAI: getattr(settings, 'LLM_MODEL', 'gpt-4o-mini'),
-            LLMProvider.ANTHROPIC: getattr(settings, 'LLM_MODEL', 'claude-3-haiku-20240307'),
-            LLMProvider.OPENROUTER: getattr(settings, 'LLM_MODEL', 'openai/gpt-4o-mini'),
-            LLMProvider.OLLAMA: getattr(settings, 'LLM_MODEL', 'llama2'),
-            LLMProvider.DEEPSEEK: getattr(settings, 'LLM_MODEL', 'deepseek-chat'),
-        }
-        return models[self.current_provider]
-    
     async def chat(self, 
                    messages: List[Dict[str, str]], 
                    temperature: float = 0.7,
@@ -113,8 +189,10 @@ class LLMManager:
                    **kwargs) -> LLMResponse:
         """Async chat with current LLM provider"""
         if self.current_provider in self.providers:
-            return await self.providers[self.current_provider](
-                messages, temperature, max_tokens, **kwargs
+            # The HTTP call is blocking: run it in the thread pool to keep the event loop free
+            call_provider = sync_to_async(self._call_provider, thread_sensitive=False)
+            return await call_provider(
+                self.providers[self.current_provider], messages, temperature, max_tokens, **kwargs
             )
         else:
             raise ValueError(f"Unsupported provider: {self.current_provider}")
@@ -130,10 +208,15 @@ class LLMManager:
             return LLMResponse(
                 content="Provider not available",
                 provider=str(self.current_provider),
-                model=self._get_model()
+                model=self.model
             )
         
-        return provider_method(messages, temperature, max_tokens, **kwargs)
+        return self._call_provider(provider_method, messages, temperature, max_tokens, **kwargs)
+    
+    def _call_provider(self, provider_method, *args, **kwargs) -> LLMResponse:
+        """Call a provider method while holding one of the concurrency slots"""
+        with self._call_slots:
+            return provider_method(*args, **kwargs)
     
     def _openai_chat(self, 
                      messages: List[Dict[str, str]], 
@@ -141,25 +224,23 @@ class LLMManager:
                      max_tokens: int,
                      **kwargs) -> LLMResponse:
         """OpenAI API implementation"""
-        url = f"{self._get_base_url()}/chat/completions"
-        headers = self._get_headers()
+        url = f"{self.base_url}/chat/completions"
+        headers = self.headers
         
         payload = {
-            "model": self._get_model(),
+            "model": self.model,
             "messages": messages,
             "temperature": temperature,
             "max_tokens": max_tokens
         }
         
         try:
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
-            response.raise_for_status()
-            data = response.json()
+            data = _post_json(url, payload, headers, timeout=30)
             
             return LLMResponse(
                 content=data['choices'][0]['message']['content'],
                 provider='openai',
-                model=self._get_model(),
+                model=self.model,
                 tokens_used=data.get('usage', {}).get('total_tokens'),
                 metadata={'finish_reason': data['choices'][0].get('finish_reason')}
             )
@@ -168,7 +249,7 @@ class LLMManager:
             return LLMResponse(
                 content="Извините, произошла ошибка. Попробуйте позже.",
                 provider='openai',
-                model=self._get_model()
+                model=self.model
             )
     
     def _openrouter_chat(self, 
@@ -177,31 +258,23 @@ class LLMManager:
                          max_tokens: int,
                          **kwargs) -> LLMResponse:
         """OpenRouter API implementation"""
-        url = f"{self._get_base_url()}/chat/completions"
-        headers = self._get_headers()
-        
-        # Add OpenRouter specific headers
-        headers.update({
-            'HTTP-Referer': getattr(settings, 'LLM_HTTP_REFERER', 'http://localhost:8000'),
-            'X-Title': 'SB Finance AI - Teen Platform'
-        })
+        url = f"{self.base_url}/chat/completions"
+        headers = self.headers
         
         payload = {
-            "model": self._get_model(),
+            "model": self.model,
             "messages": messages,
             "temperature": temperature,
             "max_tokens": max_tokens
         }
         
         try:
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
-            response.raise_for_status()
-            data = response.json()
+            data = _post_json(url, payload, headers, timeout=30)
             
             return LLMResponse(
                 content=data['choices'][0]['message']['content'],
                 provider='openrouter',
-                model=self._get_model(),
+                model=self.model,
                 tokens_used=data.get('usage', {}).get('total_tokens'),
                 metadata={'finish_reason': data['choices'][0].get('finish_reason')}
             )
@@ -210,7 +283,7 @@ class LLMManager:
             return LLMResponse(
                 content="Извините, произошла ошибка. Попробуйте позже.",
                 provider='openrouter',
-                model=self._get_model()
+                model=self.model
             )
     
     def _anthropic_chat(self, 
@@ -219,9 +292,8 @@ class LLMManager:
                         max_tokens: int,
                         **kwargs) -> LLMResponse:
         """Anthropic Claude API implementation"""
-        url = f"{self._get_base_url()}/messages"
-        headers = self._get_headers()
-        headers['anthropic-version'] = '2023-06-01'
+        url = f"{self.base_url}/messages"
+        headers = self.headers
         
         # Convert messages format for Claude
         system_message = ""
@@ -237,7 +309,7 @@ class LLMManager:
                 })
         
         payload = {
-            "model": self._get_model(),
+            "model": self.model,
             "max_tokens": max_tokens,
             "temperature": temperature,
             "messages": claude_messages
@@ -247,14 +319,12 @@ class LLMManager:
             payload["system"] = system_message
             
         try:
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
-            response.raise_for_status()
-            data = response.json()
+            data = _post_json(url, payload, headers, timeout=30)
             
             return LLMResponse(
                 content=data['content'][0]['text'],
                 provider='anthropic',
-                model=self._get_model(),
+                model=self.model,
                 tokens_used=data.get('usage', {}).get('input_tokens') + data.get('usage', {}).get('output_tokens'),
                 metadata={'stop_reason': data.get('stop_reason')}
             )
@@ -263,7 +333,7 @@ class LLMManager:
             return LLMResponse(
                 content="Извините, произошла ошибка. Попробуйте позже.",
                 provider='anthropic',
-                model=self._get_model()
+                model=self.model
             )
     
     def _ollama_chat(self, 
@@ -272,23 +342,21 @@ class LLMManager:
                      max_tokens: int,
                      **kwargs) -> LLMResponse:
         """Ollama local API implementation"""
-        url = f"{self._get_base_url()}/chat"
+        url = f"{self.base_url}/chat"
         
         payload = {
-            "model": self._get_model(),
+            "model": self.model,
             "messages": messages,
             "stream": False
         }
         
         try:
-            response = requests.post(url, json=payload, timeout=120)
-            response.raise_for_status()
-            data = response.json()
+            data = _post_json(url, payload, _JSON_HEADERS, timeout=120)
             
             return LLMResponse(
                 content=data['message']['content'],
                 provider='ollama',
-                model=self._get_model(),
+                model=self.model,
                 metadata={'model_loaded': True}
             )
         except Exception as e:
@@ -296,7 +364,7 @@ class LLMManager:
             return LLMResponse(
                 content="Локальная модель недоступна. Проверьте, что Ollama запущен.",
                 provider='ollama',
-                model=self._get_model()
+                model=self.model
             )
     
     def _deepseek_chat(self, 
@@ -305,25 +373,23 @@ class LLMManager:
                        max_tokens: int,
                        **kwargs) -> LLMResponse:
         """DeepSeek API implementation"""
-        url = f"{self._get_base_url()}/chat/completions"
-        headers = self._get_headers()
+        url = f"{self.base_url}/chat/completions"
+        headers = self.headers
         
         payload = {
-            "model": self._get_model(),
+            "model": self.model,
             "messages": messages,
             "temperature": temperature,
             "max_tokens": max_tokens
         }
         
         try:
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
-            response.raise_for_status()
-            data = response.json()
+            data = _post_json(url, payload, headers, timeout=30)
             
             return LLMResponse(
                 content=data['choices'][0]['message']['content'],
                 provider='deepseek',
-                model=self._get_model(),
+                model=self.model,
                 tokens_used=data.get('usage', {}).get('total_tokens'),
                 metadata={'finish_reason': data['choices'][0].get('finish_reason')}
             )
@@ -332,7 +398,7 @@ class LLMManager:
             return LLMResponse(
                 content="Извините, произошла ошибка. Попробуйте позже.",
                 provider='deepseek',
-                model=self._get_model()
+                model=self.model
             )
     
     def create_teen_context_prompt(self, 
@@ -340,56 +406,19 @@ class LLMManager:
                                   language: str = 'ru',
                                   current_situation: Dict = None) -> str:
         """Create context prompt for teen-appropriate responses"""
+        if language not in TEEN_CONTEXT_PROMPTS:
+            language = 'ru'
         
-        base_prompt = {
-            'ru': """
-Ты - дружелюбный финансовый коуч для подростков 13-18 лет. 
-Говори простым языком, понятным школьнику.
-Используй примеры из жизни подростков (школа, карманные деньги, покупка телефона, экономия на развлечениях).
-Будь позитивным и мотивирующим, но реалистичным.
-Всегда объясняй "почему" свои рекомендации простыми словами.
-
-Избегай:
-- Сложных финансовых терминов
-- Банковских деталей (кредиты, ипотека)
-- Взрослых примеров (семья, работа полный день)
-- Морализаторства
-
-Помогай:
-- Планировать покупки (телефон, курсы, одежда)
-- Экономить на развлечениях
-- Понимать ценность денег
-- Ставить реальные цели
-- Объяснять инфляцию простыми словами
-""",
-            'en': """
-You are a friendly financial coach for teenagers aged 13-18.
-Speak in simple language that a high school student can understand.
-Use examples from teen life (school, allowance, phone purchases, saving on entertainment).
-Be positive and motivating, but realistic.
-Always explain "why" your recommendations in simple terms.
-
-Avoid:
-- Complex financial terminology
-- Banking details (loans, mortgages)
-- Adult examples (family, full-time job)
-- Preaching
-
-Help with:
-- Planning purchases (phone, courses, clothes)
-- Saving on entertainment
-- Understanding the value of money
-- Setting realistic goals
-- Explaining inflation in simple terms
-"""
-        }
-        
+        prompt = TEEN_CONTEXT_PROMPTS[language]
         if current_situation:
-            context = f"\nТекущая ситуация пользователя: {json.dumps(current_situation, ensure_ascii=False)}"
-            base_prompt['ru'] += context
-            base_prompt['en'] += f"\nUser's current situation: {json.dumps(current_situation)}"
+            # Append to a local string, the shared base prompt is never modified
+            if language == 'ru':
+                situation = json.dumps(current_situation, ensure_ascii=False)
+                prompt += f"\nТекущая ситуация пользователя: {situation}"
+            else:
+                prompt += f"\nUser's current situation: {json.dumps(current_situation)}"
         
-        return base_prompt.get(language, base_prompt['ru'])
+        return prompt
     
     def generate_explanation(self, 
                            original_response: str,
@@ -3,6 +3,7 @@ Teen Financial Coach AI Service
 Provides age-appropriate financial guidance and education for teens
 """
 
+import asyncio
 import json
 import logging
 from typing import Dict, List, Any, Optional, Tuple
@@ -59,16 +60,28 @@ class TeenFinancialCoach:
             # Get AI response
             response = await self.llm.chat(messages, temperature=0.7, max_tokens=800)
             
-            # Analyze response for educational content
-            educational_analysis = await self._analyze_educational_content(response.content, message)
-            
-            # Save interaction to database
-            chat_session = await self._save_chat_interaction(
-                user, message, response, educational_analysis
+            # The reasoning follow-up depends only on the reply: start it now so the
+            # LLM call overlaps with saving the interaction below
+            reasoning_task = asyncio.ensure_future(
+                self._generate_reasoning(response.content, user_context)
             )
-            
-            # Check for achievements
-            await self._check_coaching_achievements(user, message, response.content)
+            try:
+                # Analyze response for educational content
+                educational_analysis = await self._analyze_educational_content(response.content, message)
+                
+                # Save interaction to database
+                chat_session = await self._save_chat_interaction(
+                    user, message, response, educational_analysis
+                )
+                
+                # Check for achievements
+                await self._check_coaching_achievements(user, message, response.content)
+                
+                ai_reasoning = await reasoning_task
+            finally:
+                # On an error above, stop the follow-up call instead of leaving it running
+                if not reasoning_task.done():
+                    reasoning_task.cancel()
             
             return {
                 'response': response.content,
@@ -78,7 +91,7 @@ class TeenFinancialCoach:
                 'learning_objective': educational_analysis.get('objective'),
                 'reasoning_explained': educational_analysis.get('reasoning'),
                 'was_actionable': educational_analysis.get('actionable', False),
-                'ai_reasoning': await self._generate_reasoning(response.content, user_context)
+                'ai_reasoning': ai_reasoning
             }
             
         except Exception as e:
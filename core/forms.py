@@ -1,75 +1,43 @@
+from decimal import Decimal
+
 from django import forms
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.contrib.auth.models import User
-from .models import Income, Expense, Event, Document
+from django.core.cache import cache
+from django.db import transaction
+from .models import Income, Expense, Event, Document, UserProfile
+from .utils.cache import (
+    PRIVATE_TOKEN_CACHE_TIMEOUT, private_token_key, private_token_owner_key,
+)
 
 
-class IncomeForm(forms.ModelForm):
-    amount = forms.FloatField(
-        required=True,
-        min_value=0.01,
-        widget=forms.NumberInput(attrs={
-            'class': 'form-control',
-            'placeholder': '0.00',
-            'step': '0.01',
-            'min': '0.01'
-        }),
-        label='Сумма',
-        help_text='Обязательное поле'
-    )
-    date = forms.DateField(
-        required=True,
-        widget=forms.DateInput(attrs={
-            'class': 'form-control',
-            'type': 'date'
-        }),
-        label='Дата',
-        help_text='Обязательное поле'
-    )
-    category = forms.CharField(
+def _category_field(datalist_id: str) -> forms.CharField:
+    """Поле категории с подсказками из <datalist> с указанным id"""
+    return forms.CharField(
         required=True,
         widget=forms.TextInput(attrs={
             'class': 'form-control',
-            'list': 'income-categories',
+            'list': datalist_id,
             'placeholder': 'Выберите или введите новую категорию',
             'autocomplete': 'off'
         }),
         label='Категория',
         help_text='Выберите из существующих или введите новую'
     )
-    description = forms.CharField(
-        required=False,
-        widget=forms.Textarea(attrs={
-            'class': 'form-control',
-            'rows': 3,
-            'placeholder': 'Автоматизация, бонус, продажа курса...',
-            'style': 'resize: vertical; min-height: 80px;'
-        }),
-        label='Описание',
-        help_text='Необязательное поле'
-    )
-    
-    class Meta:
-        model = Income
-        fields = ['amount', 'date', 'category', 'description']
-    
-    def clean_amount(self):
-        amount = self.cleaned_data.get('amount')
-        if amount is None or amount <= 0:
-            raise forms.ValidationError('Сумма должна быть больше нуля')
-        return amount
-    
-    def clean_date(self):
-        date = self.cleaned_data.get('date')
-        if date is None:
-            raise forms.ValidationError('Дата обязательна для заполнения')
-        return date
 
 
-class ExpenseForm(forms.ModelForm):
-    amount = forms.FloatField(
+class MoneyEntryForm(forms.ModelForm):
+    """
+    Общие поля форм доходов и расходов.
+    Наследники задают Meta и поле category.
+    Сумму и дату проверяют сами поля (required, min_value).
+    """
+    # Decimal сразу, как в модели (max_digits=10, decimal_places=2) — без float
+    amount = forms.DecimalField(
         required=True,
-        min_value=0.01,
+        max_digits=10,
+        decimal_places=2,
+        min_value=Decimal('0.01'),
         widget=forms.NumberInput(attrs={
             'class': 'form-control',
             'placeholder': '0.00',
@@ -88,17 +56,6 @@ class ExpenseForm(forms.ModelForm):
         label='Дата',
         help_text='Обязательное поле'
     )
-    category = forms.CharField(
-        required=True,
-        widget=forms.TextInput(attrs={
-            'class': 'form-control',
-            'list': 'expense-categories',
-            'placeholder': 'Выберите или введите новую категорию',
-            'autocomplete': 'off'
-        }),
-        label='Категория',
-        help_text='Выберите из существующих или введите новую'
-    )
     description = forms.CharField(
         required=False,
         widget=forms.Textarea(attrs={
@@ -110,6 +67,18 @@ class ExpenseForm(forms.ModelForm):
         label='Описание',
         help_text='Необязательное поле'
     )
+
+
+class IncomeForm(MoneyEntryForm):
+    category = _category_field('income-categories')
+    
+    class Meta:
+        model = Income
+        fields = ['amount', 'date', 'category', 'description']
+
+
+class ExpenseForm(MoneyEntryForm):
+    category = _category_field('expense-categories')
     auto_categorize = forms.BooleanField(
         initial=True, 
         required=False, 
@@ -122,18 +91,6 @@ class ExpenseForm(forms.ModelForm):
     class Meta:
         model = Expense
         fields = ['amount', 'date', 'category', 'description']
-    
-    def clean_amount(self):
-        amount = self.cleaned_data.get('amount')
-        if amount is None or amount <= 0:
-            raise forms.ValidationError('Сумма должна быть больше нуля')
-        return amount
-    
-    def clean_date(self):
-        date = self.cleaned_data.get('date')
-        if date is None:
-            raise forms.ValidationError('Дата обязательна для заполнения')
-        return date
 
 
 class EventForm(forms.ModelForm):
@@ -148,6 +105,20 @@ class DocumentForm(forms.ModelForm):
         fields = ['doc_type', 'params', 'generated_text']
 
 
+# Атрибуты виджетов стандартных полей auth-форм (поле, attrs); собираются один раз
+_REGISTRATION_WIDGET_ATTRS = (
+    ('username', {'class': 'form-control', 'placeholder': 'Имя пользователя'}),
+    ('email', {'class': 'form-control', 'placeholder': 'Email (опционально)'}),
+    ('password1', {'class': 'form-control', 'placeholder': 'Пароль'}),
+    ('password2', {'class': 'form-control', 'placeholder': 'Подтверждение пароля'}),
+    ('anonymous_mode', {'class': 'form-check-input'}),
+)
+_LOGIN_WIDGET_ATTRS = (
+    ('username', {'class': 'form-control', 'placeholder': 'Имя пользователя или Email'}),
+    ('password', {'class': 'form-control', 'placeholder': 'Пароль'}),
+)
+
+
 class CustomUserCreationForm(UserCreationForm):
     """
     Форма регистрации с поддержкой анонимной регистрации.
@@ -179,11 +150,8 @@ class CustomUserCreationForm(UserCreationForm):
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.fields['username'].widget.attrs.update({'class': 'form-control', 'placeholder': 'Имя пользователя'})
-        self.fields['email'].widget.attrs.update({'class': 'form-control', 'placeholder': 'Email (опционально)'})
-        self.fields['password1'].widget.attrs.update({'class': 'form-control', 'placeholder': 'Пароль'})
-        self.fields['password2'].widget.attrs.update({'class': 'form-control', 'placeholder': 'Подтверждение пароля'})
-        self.fields['anonymous_mode'].widget.attrs.update({'class': 'form-check-input'})
+        for name, attrs in _REGISTRATION_WIDGET_ATTRS:
+            self.fields[name].widget.attrs.update(attrs)
     
     def clean(self):
         cleaned_data = super().clean()
@@ -202,17 +170,39 @@ class CustomUserCreationForm(UserCreationForm):
         if email:
             user.email = email
         if commit:
-            user.save()
-            # Создаём профиль пользователя
-            from .models import UserProfile
-            bio = self.cleaned_data.get('bio')
-            profile = UserProfile.objects.create(
-                user=user,
-                bio=bio
-            )
+            # Пользователь и профиль сохраняются одной транзакцией
+            with transaction.atomic():
+                user.save()
+                UserProfile.objects.create(
+                    user=user,
+                    bio=self.cleaned_data.get('bio')
+                )
         return user
 
 
+def _resolve_private_token(token: str):
+    """
+    Возвращает id пользователя по приватному токену или None.
+    Результат (в т.ч. отрицательный) кэшируется на минуту, чтобы повторные
+    попытки входа с тем же токеном не ходили в БД; сброс — в core/signals.py.
+    """
+    key = private_token_key(token)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached or None
+
+    user_id = (
+        UserProfile.objects.filter(private_token=token)
+        .values_list('user_id', flat=True)
+        .first()
+    )
+    # 0 — «токен не найден»: None от cache.get означает промах кэша
+    cache.set(key, user_id or 0, PRIVATE_TOKEN_CACHE_TIMEOUT)
+    if user_id:
+        cache.set(private_token_owner_key(user_id), key, PRIVATE_TOKEN_CACHE_TIMEOUT)
+    return user_id
+
+
 class CustomAuthenticationForm(AuthenticationForm):
     """
     Форма входа с поддержкой приватного токена.
@@ -226,31 +216,34 @@ class CustomAuthenticationForm(AuthenticationForm):
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.fields['username'].widget.attrs.update({'class': 'form-control', 'placeholder': 'Имя пользователя или Email'})
-        self.fields['password'].widget.attrs.update({'class': 'form-control', 'placeholder': 'Пароль'})
+        for name, attrs in _LOGIN_WIDGET_ATTRS:
+            self.fields[name].widget.attrs.update(attrs)
         self.fields['password'].required = False  # Пароль не обязателен, если есть токен
     
     def clean(self):
-        cleaned_data = super().clean()
-        username = cleaned_data.get('username')
-        password = cleaned_data.get('password')
+        cleaned_data = self.cleaned_data
         private_token = cleaned_data.get('private_token')
         
-        # Если передан приватный токен, проверяем его
+        # Если передан приватный токен, проверяем только его: родительский clean()
+        # и authenticate() не нужны — они проверяли бы пароль, которого нет
         if private_token:
-            from .models import UserProfile
-            try:
-                profile = UserProfile.objects.get(private_token=private_token)
-                from django.contrib.auth import authenticate
-                user = authenticate(self.request, username=profile.user.username, password=None)
-                if user:
-                    cleaned_data['user'] = user
-                    return cleaned_data
-            except UserProfile.DoesNotExist:
+            user_id = _resolve_private_token(private_token)
+            if user_id is None:
                 raise forms.ValidationError('Неверный приватный токен')
+            # Только поля, которые нужны для входа: is_active — проверка,
+            # password — хеш сессии, last_login — update_last_login
+            user = User.objects.only(
+                'id', 'username', 'password', 'is_active', 'last_login'
+            ).get(pk=user_id)
+            self.confirm_login_allowed(user)
+            user.backend = 'django.contrib.auth.backends.ModelBackend'
+            self.user_cache = user
+            cleaned_data['user'] = user
+            return cleaned_data
         
         # Обычная проверка пароля
-        if not password:
+        cleaned_data = super().clean()
+        if not cleaned_data.get('password'):
             raise forms.ValidationError('Введите пароль или приватный токен')
         
         return cleaned_data
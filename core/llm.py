@@ -1,13 +1,17 @@
-import json
 import hashlib
 import re
-from typing import List, Dict, Any, Optional, Set
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from django.conf import settings
+from django.core.cache import cache
 from django.db.models import Q
 
 from core.models import ChatMessage, ChatSession
+from core.utils import fast_json
 from core.utils.anonymizer import anonymize_text, anonymize_csv_data
 from core.utils.analytics import (
     get_user_financial_memory,
@@ -16,10 +20,35 @@ from core.utils.analytics import (
     detect_anomalies_automatically,
 )
 
-try:
-    import google.generativeai as genai
-except ImportError:
-    genai = None
+# Общая сессия: keep-alive избавляет каждый запрос к LLM от нового TCP/TLS-рукопожатия.
+# Повторяем только неудавшиеся подключения; ошибки по статусу (429/5xx)
+# обрабатывает переход на резервные модели (_first_completion)
+_http = requests.Session()
+_http.mount('https://', HTTPAdapter(
+    pool_connections=8, pool_maxsize=32,
+    max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2),
+))
+_http.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=8))
+
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# google.generativeai тянет grpc/protobuf (сотни мс на импорт), поэтому
+# загружаем его только при первом обращении к Gemini
+_genai = None
+_genai_missing = False
+
+
+def _get_genai():
+    """Возвращает модуль google.generativeai или None, если он не установлен"""
+    global _genai, _genai_missing
+    if _genai is None and not _genai_missing:
+        try:
+            import google.generativeai as genai
+        except ImportError:
+            _genai_missing = True
+        else:
+            _genai = genai
+    return _genai
 
 
 # ============================================================================
@@ -31,6 +60,36 @@ except ImportError:
 # LLM_MODEL=openai/gpt-4o-mini
 # ============================================================================
 
+# Сколько хранить ответ модели на точно такой же запрос (модель, сообщения, лимиты)
+LLM_RESPONSE_CACHE_TIMEOUT = 3600
+
+# Сколько моделей из списка (основная + резервные) опрашивать одновременно
+MODEL_RACE_SIZE = 2
+
+# Сколько последних ответов ассистента сверяется по фрагментам
+# (точные повторы ищутся по всей сессии через индекс content_hash)
+DUPLICATE_CHECK_HISTORY_LIMIT = 30
+
+
+def _completion_cache_key(payload: Dict[str, Any]) -> str:
+    """
+    Ключ кэша ответа LLM. Сообщения в payload уже анонимизированы,
+    поэтому одинаковые после анонимизации запросы получают один ключ.
+    """
+    # Ключи payload всегда собираются в одном порядке (model, messages, max_tokens)
+    raw = fast_json.dumps(payload)
+    return f"llm_reply:{hashlib.blake2b(raw, digest_size=16).hexdigest()}"
+
+
+# Резервные модели для бесплатных/экспериментальных моделей (по порядку попыток)
+_FALLBACK_MODELS = (
+    'google/gemini-2.0-flash-exp:free',
+    'deepseek/deepseek-r1:free',
+    'meta-llama/llama-3-8b-instruct:free',
+    'deepseek/deepseek-chat',  # Cheap paid as last resort
+)
+
+
 def _headers() -> Dict[str, str]:
     """
     Формирует заголовки для запроса к LLM API.
@@ -59,11 +118,19 @@ def _headers() -> Dict[str, str]:
     return headers
 
 
+_SPACES_RE = re.compile(r'\s+')
+# Строка начинается с маркера списка или номера пункта
+_LIST_MARKER_RE = re.compile(r'[-*•\d+\.]')
+
+
+def _normalize_content(content: str) -> str:
+    """Нормализует текст для сравнения: без лишних пробелов, в нижнем регистре"""
+    return _SPACES_RE.sub(' ', content.strip().lower())
+
+
 def _compute_content_hash(content: str) -> str:
     """Вычисляет SHA256 хеш содержимого для проверки на повторения"""
-    # Нормализуем: удаляем лишние пробелы, приводим к нижнему регистру для сравнения
-    normalized = re.sub(r'\s+', ' ', content.strip().lower())
-    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+    return hashlib.sha256(_normalize_content(content).encode('utf-8')).hexdigest()
 
 
 def _extract_advice_snippets(content: str) -> List[str]:
@@ -80,7 +147,7 @@ def _extract_advice_snippets(content: str) -> List[str]:
                 current_snippet = []
             continue
         # Проверяем, начинается ли строка с маркера списка
-        if re.match(r'^[-*•\d+\.]', line):
+        if _LIST_MARKER_RE.match(line):
             if current_snippet:
                 snippets.append(' '.join(current_snippet))
             current_snippet = [line]
@@ -97,38 +164,84 @@ def _check_for_duplicates(new_content: str, session: ChatSession, similarity_thr
     Возвращает True, если найдены дубликаты.
     similarity_threshold: порог схожести (0-1), по умолчанию 0.8
     """
-    new_hash = _compute_content_hash(new_content)
+    assistant_messages = ChatMessage.objects.filter(session=session, role='assistant')
+    
+    # Точный повтор находим одним индексным запросом, не загружая тексты
+    if assistant_messages.filter(content_hash=_compute_content_hash(new_content)).exists():
+        return True
+    
+    # Фрагменты нового ответа готовим один раз. Хеши фрагментов совпадают
+    # ровно тогда, когда совпадают нормализованные тексты, поэтому сравниваем
+    # их напрямую — множеством, без SHA256 на каждую пару
     new_snippets = _extract_advice_snippets(new_content)
+    new_normalized = {_normalize_content(snip) for snip in new_snippets}
+    new_long = [snip.lower() for snip in new_snippets if len(snip) > 20]
     
-    # Получаем все предыдущие ответы ассистента в этой сессии
-    previous_messages = ChatMessage.objects.filter(
-        session=session,
-        role='assistant'
-    ).exclude(content_hash=new_hash)
+    # По фрагментам сверяем только последние ответы, читая их порциями
+    # (фрагменты сохранены при записи ответа; старые записи разбираем на лету)
+    previous = assistant_messages.order_by('-created_at').values_list(
+        'advice_snippets', 'content'
+    )[:DUPLICATE_CHECK_HISTORY_LIMIT]
     
-    for prev_msg in previous_messages:
-        prev_hash = prev_msg.content_hash
-        # Простая проверка по хешу
-        if new_hash == prev_hash:
+    prev_long = []
+    for prev_snippets, prev_content in previous.iterator(chunk_size=50):
+        if prev_snippets is None:
+            prev_snippets = _extract_advice_snippets(prev_content)
+        if not new_normalized.isdisjoint(_normalize_content(snip) for snip in prev_snippets):
             return True
-        
-        # Проверка по извлеченным фрагментам
-        prev_snippets = _extract_advice_snippets(prev_msg.content)
-        for new_snip in new_snippets:
-            new_snip_hash = _compute_content_hash(new_snip)
-            for prev_snip in prev_snippets:
-                prev_snip_hash = _compute_content_hash(prev_snip)
-                # Если хеши совпадают или очень похожи по длине и содержанию
-                if new_snip_hash == prev_snip_hash:
-                    return True
-                # Дополнительная проверка: если один фрагмент содержит другой
-                if len(new_snip) > 20 and len(prev_snip) > 20:
-                    new_lower = new_snip.lower()
-                    prev_lower = prev_snip.lower()
-                    if new_lower in prev_lower or prev_lower in new_lower:
-                        return True
-    
-    return False
+        prev_long.extend(snip.lower() for snip in prev_snippets if len(snip) > 20)
+    
+    if not new_long or not prev_long:
+        return False
+    
+    # Дополнительная проверка: если один фрагмент содержит другой.
+    # Фрагменты не содержат '\n' (текст режется по строкам), поэтому вхождение
+    # в склейку через '\n' равносильно вхождению в один из фрагментов —
+    # вместо перебора всех пар делаем по одному поиску на фрагмент
+    prev_joined = '\n'.join(prev_long)
+    new_joined = '\n'.join(new_long)
+    return (
+        any(new_lower in prev_joined for new_lower in new_long)
+        or any(prev_lower in new_joined for prev_lower in prev_long)
+    )
+
+
+def _system_message(sys_prompt: str, system_blocks: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """
+    Формирует системное сообщение для OpenAI-совместимого API.
+
+    Если переданы system_blocks, ведущие блоки с cache_control отправляются
+    как есть (байт-в-байт одинаковый префикс для кэша провайдера), а остаток
+    sys_prompt (контекст пользователя, доп. инструкции) — последним блоком.
+    """
+    if not system_blocks:
+        return {"role": "system", "content": sys_prompt}
+
+    content = []
+    offset = 0
+    for block in system_blocks:
+        if 'cache_control' not in block or not sys_prompt.startswith(block['text'], offset):
+            break
+        content.append(block)
+        offset += len(block['text'])
+
+    if offset < len(sys_prompt):
+        content.append({'type': 'text', 'text': sys_prompt[offset:]})
+
+    return {"role": "system", "content": content}
+
+
+def _record_usage(usage: Optional[Dict[str, int]], data: Dict[str, Any]) -> None:
+    """Сохраняет статистику токенов из ответа API (включая попадания в кэш промпта)"""
+    if usage is None:
+        return
+    raw = data.get('usage') or {}
+    details = raw.get('prompt_tokens_details') or {}
+    usage['prompt_tokens'] = raw.get('prompt_tokens', 0) or 0
+    usage['completion_tokens'] = raw.get('completion_tokens', 0) or 0
+    usage['cache_read_input_tokens'] = (
+        raw.get('cache_read_input_tokens') or details.get('cached_tokens') or 0
+    )
 
 
 def get_ai_advice_from_data(data_blob: str, extra_instruction: str = "", anonymize: bool = True, user=None) -> str:
@@ -186,13 +299,18 @@ def get_ai_advice_from_data(data_blob: str, extra_instruction: str = "", anonymi
         "messages": messages,
         "max_tokens": getattr(settings, 'LLM_MAX_TOKENS', 4000),  # Ограничиваем токены для экономии
     }
+    cache_key = _completion_cache_key(payload)
+    cached_reply = cache.get(cache_key)
+    if cached_reply is not None:
+        return cached_reply
+
     try:
-        resp = requests.post(settings.LLM_API_URL, headers=_headers(), json=payload, timeout=60)
+        resp = _http.post(settings.LLM_API_URL, headers=_headers(), data=fast_json.dumps(payload), timeout=60)
         
         if resp.status_code != 200:
             error_detail = f"HTTP {resp.status_code}"
             try:
-                error_data = resp.json()
+                error_data = fast_json.loads(resp.content)
                 if 'error' in error_data:
                     error_msg = error_data['error'].get('message', str(error_data['error']))
                     error_detail = error_msg
@@ -203,95 +321,62 @@ def get_ai_advice_from_data(data_blob: str, extra_instruction: str = "", anonymi
                 error_detail = resp.text[:200] if resp.text else f"HTTP {resp.status_code}"
             return f"[AI ошибка] {error_detail}"
         
-        data = resp.json()
+        data = fast_json.loads(resp.content)
         if 'choices' not in data or not data['choices']:
             return "[AI ошибка] Неожиданный формат ответа от API."
-        return data['choices'][0]['message']['content']
+        reply = data['choices'][0]['message']['content']
+        cache.set(cache_key, reply, LLM_RESPONSE_CACHE_TIMEOUT)
+        return reply
     except requests.exceptions.RequestException as ex:
         return f"[AI ошибка] Ошибка сети: {ex}"
     except Exception as ex:
         return f"[AI ошибка] Не удалось получить ответ модели: {ex}"
 
 
-def chat_with_context(
-    messages: List[Dict[str, str]], 
-    user_data: str = "",
-    session: Optional[ChatSession] = None,
-    check_duplicates: bool = True,
-    anonymize: bool = True,
-    use_local: bool = False,
-    user=None,
-    system_instruction: Optional[str] = None
-) -> str:
-    """
-    Chat-style call с поддержкой истории и проверкой на повторения.
-    
-    Args:
-        messages: list of {role: 'user'|'assistant'|'system', content: str}
-        user_data: CSV/JSON compact data to ground the answers (дополнительный контекст)
-        session: ChatSession для сохранения истории и проверки на повторения
-        check_duplicates: если True, проверяет на повторения советов
-        anonymize: если True, анонимизирует данные перед отправкой в облако
-        use_local: если True, использует локальную модель (Ollama)
-        user: User объект для получения финансовой памяти
-        system_instruction: Кастомный системный промпт (переопределяет стандартный)
-    
-    Returns:
-        Ответ от LLM
-    """
-    # Локальный режим (Ollama)
-    if use_local:
-        return _call_local_llm(messages, user_data, user=user)
-    
-    # ------------------------------------------------------------------
-    # Определяем, нужно ли использовать Google Gemini напрямую
-    # ------------------------------------------------------------------
+def _use_google_direct() -> bool:
+    """Определяет, нужно ли использовать Google Gemini напрямую"""
     model_name = getattr(settings, 'LLM_MODEL', 'deepseek-chat-v3.1:free').lower()
     has_google_key = bool(getattr(settings, 'GOOGLE_API_KEY', ''))
     has_llm_key = bool(getattr(settings, 'LLM_API_KEY', ''))
-    
-    # Инициализируем переменную memory
-    memory = None
 
     # Используем Gemini напрямую если:
     # 1. Выбрана модель Gemini И есть Google API ключ (даже если есть OpenRouter ключ - прямой доступ надежнее)
     # 2. НЕТ OpenRouter ключа, но есть Google API ключ (fallback)
     is_gemini_model = 'gemini' in model_name
-    use_google_direct = (is_gemini_model and has_google_key) or (has_google_key and not has_llm_key)
-    
-    if use_google_direct:
-        # Для Gemini нам нужен sys_prompt отдельно
-        if system_instruction:
-            sys_prompt = system_instruction
-        else:
-            # Получаем финансовую память
-            memory = None
-            if user:
-                try:
-                    memory = get_user_financial_memory(user, force_refresh=False)
-                except Exception:
-                    pass
-            
-            if memory:
-                 sys_prompt = build_system_prompt(memory, extra_context=user_data or "")
-            else:
-                 if anonymize and user_data:
-                     anonymized_data = anonymize_csv_data(user_data)
-                 else:
-                     anonymized_data = user_data
-                 sys_prompt = settings.LLM_PROMPT_TEMPLATE.format(user_data=anonymized_data or "Нет данных")
-        
-        if check_duplicates and session:
-            sys_prompt += "\n\nВАЖНО: Не повторяй ранее данные советы в этой сессии. Всегда давай новые, уникальные рекомендации."
-            
-        return _call_google_gemini(messages, sys_prompt)
+    return (is_gemini_model and has_google_key) or (has_google_key and not has_llm_key)
+
+
+def _models_to_try(model: str) -> List[str]:
+    """Основная модель и, для бесплатных/экспериментальных, резервные"""
+    models_to_try = [model]
     
+    # Добавляем fallback модели, если используемая модель бесплатная или экспериментальная
+    if ':free' in model or 'exp' in model:
+        for fb in _FALLBACK_MODELS:
+            if fb != model and fb not in models_to_try:
+                models_to_try.append(fb)
+    return models_to_try
+
+
+def _base_system_prompt(
+    user_data: str,
+    session: Optional[ChatSession],
+    check_duplicates: bool,
+    anonymize: bool,
+    user,
+    system_instruction: Optional[str],
+) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Системный промпт для облачных провайдеров (OpenAI-совместимых и Gemini).
+    Возвращает (sys_prompt, memory); memory — None, если промпт собран без нее.
+    """
+    memory = None
+
     # Если передан кастомный системный промпт, используем его
     if system_instruction:
         sys_prompt = system_instruction
     else:
         # Получаем финансовую память пользователя (таблицы, summary, alerts)
-        memory = None
         if user:
             try:
                 memory = get_user_financial_memory(user, force_refresh=False)
@@ -309,11 +394,31 @@ def chat_with_context(
             else:
                 anonymized_data = user_data
             sys_prompt = settings.LLM_PROMPT_TEMPLATE.format(user_data=anonymized_data or "Нет данных")
-    
+
     # Добавляем инструкцию о недопустимости повторений
     if check_duplicates and session:
         sys_prompt += "\n\nВАЖНО: Не повторяй ранее данные советы в этой сессии. Всегда давай новые, уникальные рекомендации."
-    
+
+    return sys_prompt, memory
+
+
+def _prepare_cloud_prompt(
+    messages: List[Dict[str, str]],
+    user_data: str,
+    session: Optional[ChatSession],
+    check_duplicates: bool,
+    anonymize: bool,
+    user,
+    system_instruction: Optional[str],
+) -> Tuple[str, List[Dict[str, str]]]:
+    """
+    Готовит системный промпт и (анонимизированные) сообщения для облачной LLM.
+    Возвращает (sys_prompt, messages).
+    """
+    sys_prompt, memory = _base_system_prompt(
+        user_data, session, check_duplicates, anonymize, user, system_instruction
+    )
+
     # Анонимизируем сообщения пользователя (если используется облако и память не анонимизирована)
     if anonymize and not memory:
         anonymized_messages = []
@@ -338,7 +443,7 @@ def chat_with_context(
             else:
                 anonymized_messages.append(msg)
         messages = anonymized_messages
-    
+
     # Ограничиваем длину системного промпта (слишком длинные промпты могут вызывать ошибки)
     max_system_length = 8000  # Увеличиваем лимит для таблиц
     if len(sys_prompt) > max_system_length:
@@ -348,75 +453,265 @@ def chat_with_context(
             sys_prompt = parts[0] + "\n\n### Дополнительный контекст\n[Данные обрезаны для оптимизации]"
         else:
             sys_prompt = sys_prompt[:max_system_length] + "\n\n[Данные обрезаны для оптимизации]"
+
+    return sys_prompt, messages
+
+
+def chat_with_context(
+    messages: List[Dict[str, str]], 
+    user_data: str = "",
+    session: Optional[ChatSession] = None,
+    check_duplicates: bool = True,
+    anonymize: bool = True,
+    use_local: bool = False,
+    user=None,
+    system_instruction: Optional[str] = None,
+    system_blocks: Optional[List[Dict[str, Any]]] = None,
+    usage: Optional[Dict[str, int]] = None
+) -> str:
+    """
+    Chat-style call с поддержкой истории и проверкой на повторения.
     
-    full_messages = [{"role": "system", "content": sys_prompt}] + messages
+    Args:
+        messages: list of {role: 'user'|'assistant'|'system', content: str}
+        user_data: CSV/JSON compact data to ground the answers (дополнительный контекст)
+        session: ChatSession для сохранения истории и проверки на повторения
+        check_duplicates: если True, проверяет на повторения советов
+        anonymize: если True, анонимизирует данные перед отправкой в облако
+        use_local: если True, использует локальную модель (Ollama)
+        user: User объект для получения финансовой памяти
+        system_instruction: Кастомный системный промпт (переопределяет стандартный)
+        system_blocks: Системный промпт блоками [{type, text, cache_control?}].
+            Блоки с cache_control должны идти первыми — это статический префикс,
+            который кэшируется провайдером. Имеет приоритет над system_instruction.
+        usage: dict, который заполняется статистикой токенов из ответа API
     
-    # Получаем модель из настроек или параметров запроса
-    model = getattr(settings, 'LLM_MODEL', 'deepseek-chat-v3.1:free')
+    Returns:
+        Ответ от LLM
+    """
+    # Локальный режим (Ollama)
+    if use_local:
+        return _call_local_llm(messages, user_data, user=user)
     
-    models_to_try = [model]
+    if system_blocks:
+        system_instruction = "".join(block['text'] for block in system_blocks)
+
+    if _use_google_direct():
+        # Для Gemini нам нужен sys_prompt отдельно
+        sys_prompt, _ = _base_system_prompt(user_data, session, check_duplicates, anonymize, user, system_instruction)
+        return _call_google_gemini(messages, sys_prompt)
     
-    # Добавляем fallback модели, если используемая модель бесплатная или экспериментальная
-    if ':free' in model or 'exp' in model:
-        fallbacks = [
-            'google/gemini-2.0-flash-exp:free',
-            'deepseek/deepseek-r1:free',
-            'meta-llama/llama-3-8b-instruct:free',
-            'deepseek/deepseek-chat',  # Cheap paid as last resort
-        ]
-        for fb in fallbacks:
-            if fb != model and fb not in models_to_try:
-                models_to_try.append(fb)
+    sys_prompt, messages = _prepare_cloud_prompt(
+        messages, user_data, session, check_duplicates, anonymize, user, system_instruction
+    )
     
-    last_error = ""
+    full_messages = [_system_message(sys_prompt, system_blocks)] + messages
+    
+    # Получаем модель из настроек или параметров запроса
+    model = getattr(settings, 'LLM_MODEL', 'deepseek-chat-v3.1:free')
+    
+    reply, current_model, last_error = _first_completion(_models_to_try(model), full_messages, usage)
+    if reply is None:
+        # Если ни одна модель не сработала
+        return f"[AI Error] Все модели недоступны. Последняя ошибка: {last_error}"
     
-    for current_model in models_to_try:
+    # Проверяем на повторения, если включена проверка
+    if check_duplicates and session and _check_for_duplicates(reply, session):
+        sys_prompt += "\n\nОбнаружены повторения в предыдущих ответах. Пожалуйста, дай совершенно новый, уникальный совет, который еще не был дан в этой сессии."
         payload = {
             "model": current_model,
-            "messages": full_messages,
+            "messages": [_system_message(sys_prompt, system_blocks)] + messages,
             "max_tokens": getattr(settings, 'LLM_MAX_TOKENS', 4000),
         }
+        # Повторный запрос к той же модели
+        try:
+            resp_retry = _http.post(settings.LLM_API_URL, headers=_headers(), data=fast_json.dumps(payload), timeout=60)
+            if resp_retry.status_code == 200:
+                data_retry = fast_json.loads(resp_retry.content)
+                if 'choices' in data_retry and data_retry['choices']:
+                    _record_usage(usage, data_retry)
+                    return data_retry['choices'][0]['message']['content']
+        except (requests.RequestException, fast_json.JSONDecodeError):
+            pass
+    
+    return reply
+
+
+def _request_completion(
+    model: str, full_messages: List[Dict[str, Any]]
+) -> Tuple[Optional[str], Optional[Dict[str, Any]], str]:
+    """
+    Один запрос к модели (или ответ из кэша).
+    Возвращает (reply, data, error): data — ответ API, None для ответа из кэша.
+    """
+    payload = {
+        "model": model,
+        "messages": full_messages,
+        "max_tokens": getattr(settings, 'LLM_MAX_TOKENS', 4000),
+    }
+    cache_key = _completion_cache_key(payload)
+    reply = cache.get(cache_key)
+    if reply is not None:
+        return reply, None, ""
+    
+    try:
+        resp = _http.post(settings.LLM_API_URL, headers=_headers(), data=fast_json.dumps(payload), timeout=60)
+        if resp.status_code == 200:
+            data = fast_json.loads(resp.content)
+            if 'choices' in data and data['choices']:
+                reply = data['choices'][0]['message']['content']
+                cache.set(cache_key, reply, LLM_RESPONSE_CACHE_TIMEOUT)
+                return reply, data, ""
         
         try:
-            # print(f"Trying model: {current_model}")
-            resp = requests.post(settings.LLM_API_URL, headers=_headers(), json=payload, timeout=60)
-            
-            if resp.status_code == 200:
-                data = resp.json()
-                if 'choices' in data and data['choices']:
-                    reply = data['choices'][0]['message']['content']
-                    
-                    # Проверяем на повторения, если включена проверка
-                    if check_duplicates and session:
-                        if _check_for_duplicates(reply, session):
-                            sys_prompt += "\n\nОбнаружены повторения в предыдущих ответах. Пожалуйста, дай совершенно новый, уникальный совет, который еще не был дан в этой сессии."
-                            full_messages = [{"role": "system", "content": sys_prompt}] + messages
-                            payload['messages'] = full_messages
-                            # Повторный запрос к той же модели
-                            resp_retry = requests.post(settings.LLM_API_URL, headers=_headers(), json=payload, timeout=60)
-                            if resp_retry.status_code == 200:
-                                data_retry = resp_retry.json()
-                                if 'choices' in data_retry and data_retry['choices']:
-                                    return data_retry['choices'][0]['message']['content']
-                    
-                    return reply
-            
-            # Если ошибка, сохраняем и пробуем следующую
-            try:
-                err_data = resp.json()
-                err_msg = err_data.get('error', {}).get('message', str(err_data))
-                last_error = f"{current_model}: {err_msg}"
-            except:
-                last_error = f"{current_model}: HTTP {resp.status_code}"
-                
-        except Exception as e:
-            last_error = f"{current_model}: {str(e)}"
-            continue
-            
-    # Если ни одна модель не сработала
-    return f"[AI Error] Все модели недоступны. Последняя ошибка: {last_error}"
+            err_data = fast_json.loads(resp.content)
+            err_msg = err_data.get('error', {}).get('message', str(err_data))
+            return None, None, f"{model}: {err_msg}"
+        except:
+            return None, None, f"{model}: HTTP {resp.status_code}"
+    except Exception as e:
+        return None, None, f"{model}: {str(e)}"
+
+
+def _first_completion(
+    models_to_try: List[str],
+    full_messages: List[Dict[str, Any]],
+    usage: Optional[Dict[str, int]] = None
+) -> Tuple[Optional[str], str, str]:
+    """
+    Первый успешный ответ из списка моделей: (reply, model, last_error).
+    Первые MODEL_RACE_SIZE моделей опрашиваются одновременно — если основная
+    бесплатная модель упирается в квоту или таймаут, не ждем ее перед
+    резервной. Остальные пробуются по очереди.
+    """
+    racing = models_to_try[:MODEL_RACE_SIZE]
+    last_error = ""
+    
+    if len(racing) > 1:
+        executor = ThreadPoolExecutor(max_workers=len(racing))
+        futures = {
+            executor.submit(_request_completion, current_model, full_messages): current_model
+            for current_model in racing
+        }
+        try:
+            for future in as_completed(futures):
+                reply, data, error = future.result()
+                if reply is not None:
+                    if data is not None:
+                        _record_usage(usage, data)
+                    return reply, futures[future], ""
+                last_error = error
+        finally:
+            # Проигравшие запросы не ждем: их ответы просто не используются
+            executor.shutdown(wait=False, cancel_futures=True)
+        sequential = models_to_try[len(racing):]
+    else:
+        sequential = models_to_try
+    
+    for current_model in sequential:
+        reply, data, error = _request_completion(current_model, full_messages)
+        if reply is not None:
+            if data is not None:
+                _record_usage(usage, data)
+            return reply, current_model, ""
+        last_error = error
+    
+    return None, "", last_error
 
 
+def stream_chat_with_context(
+    messages: List[Dict[str, str]],
+    user_data: str = "",
+    session: Optional[ChatSession] = None,
+    check_duplicates: bool = True,
+    anonymize: bool = True,
+    use_local: bool = False,
+    user=None,
+    system_instruction: Optional[str] = None,
+    system_blocks: Optional[List[Dict[str, Any]]] = None,
+    usage: Optional[Dict[str, int]] = None
+) -> Iterator[str]:
+    """
+    Потоковый вариант chat_with_context (те же аргументы): отдает ответ
+    фрагментами по мере генерации моделью (stream=True в OpenAI-совместимом API).
+    
+    Локальная модель, Gemini, ответ из кэша и переход на резервные модели
+    после ошибки основной отдаются одним фрагментом через chat_with_context.
+    Перезапрос при повторах не выполняется — ответ уже показан пользователю.
+    Если поток оборвался, пришел кадр с ошибкой или ответ оказался пустым,
+    генератор выбрасывает исключение (requests.RequestException или ValueError),
+    а не дописывает ошибку в текст.
+    """
+    if use_local or _use_google_direct():
+        yield chat_with_context(
+            messages, user_data, session, check_duplicates, anonymize, use_local,
+            user, system_instruction, system_blocks, usage
+        )
+        return
+    
+    if system_blocks:
+        system_instruction = "".join(block['text'] for block in system_blocks)
+    sys_prompt, cloud_messages = _prepare_cloud_prompt(
+        messages, user_data, session, check_duplicates, anonymize, user, system_instruction
+    )
+    payload = {
+        "model": getattr(settings, 'LLM_MODEL', 'deepseek-chat-v3.1:free'),
+        "messages": [_system_message(sys_prompt, system_blocks)] + cloud_messages,
+        "max_tokens": getattr(settings, 'LLM_MAX_TOKENS', 4000),
+    }
+    cache_key = _completion_cache_key(payload)
+    reply = cache.get(cache_key)
+    if reply is not None:
+        yield reply
+        return
+    
+    try:
+        resp = _http.post(
+            settings.LLM_API_URL, headers=_headers(), data=fast_json.dumps({**payload, "stream": True}),
+            stream=True, timeout=60
+        )
+    except requests.exceptions.RequestException:
+        resp = None
+    
+    if resp is None or resp.status_code != 200:
+        if resp is not None:
+            resp.close()
+        # Основная модель недоступна — обычный запрос с перебором резервных
+        yield chat_with_context(
+            messages, user_data, session, check_duplicates, anonymize, use_local,
+            user, system_instruction, system_blocks, usage
+        )
+        return
+    
+    # Обрыв соединения или битый фрагмент посреди ответа пробрасываются
+    # наружу: неполный ответ нельзя ни кэшировать, ни сохранять в историю
+    parts = []
+    with resp:
+        for line in resp.iter_lines():
+            # Строки SSE: "data: {...}", "data: [DONE]" и комментарии ": ..."
+            if not line.startswith(b'data: '):
+                continue
+            data = line[len(b'data: '):]
+            if data == b'[DONE]':
+                break
+            chunk = fast_json.loads(data)
+            # Ошибка провайдера посреди потока приходит кадром с HTTP 200
+            if chunk.get('error'):
+                error = chunk['error']
+                message = error.get('message', error) if isinstance(error, dict) else error
+                raise ValueError(f"Ошибка потока LLM: {message}")
+            if chunk.get('usage'):
+                _record_usage(usage, chunk)
+            choices = chunk.get('choices')
+            delta = choices[0].get('delta', {}).get('content') if choices else None
+            if delta:
+                parts.append(delta)
+                yield delta
+    
+    if not parts:
+        raise ValueError("LLM вернула пустой ответ")
+    cache.set(cache_key, ''.join(parts), LLM_RESPONSE_CACHE_TIMEOUT)
+
 
 def _call_local_llm(messages: List[Dict[str, str]], user_data: str = "", user=None) -> str:
     """
@@ -459,12 +754,12 @@ def _call_local_llm(messages: List[Dict[str, str]], user_data: str = "", user=No
     }
     
     try:
-        resp = requests.post(ollama_url, json=payload, timeout=120)
+        resp = _http.post(ollama_url, headers=_JSON_HEADERS, data=fast_json.dumps(payload), timeout=120)
         
         if resp.status_code != 200:
             return f"[Локальная LLM ошибка] HTTP {resp.status_code}. Убедитесь, что Ollama запущен."
         
-        data = resp.json()
+        data = fast_json.loads(resp.content)
         if 'message' in data and 'content' in data['message']:
             return data['message']['content']
         elif 'response' in data:
@@ -482,6 +777,7 @@ def _call_google_gemini(messages: List[Dict[str, str]], sys_prompt: str) -> str:
     """
     Вызывает Google Gemini напрямую через SDK.
     """
+    genai = _get_genai()
     if not genai:
         return "[System Error] google-generativeai package not installed."
         
@@ -0,0 +1,47 @@
+"""
+Nightly pre-generation of dashboard quick insights.
+
+Schedule once per night (cron / Render cron job):
+    python manage.py refresh_quick_insights
+"""
+
+import asyncio
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from core.ai.advisor import get_advice_batch, save_quick_insights
+
+
+class Command(BaseCommand):
+    help = 'Pre-generate dashboard quick insights for recently active users'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=7,
+            help='Only users who logged in within this many days (default: 7)'
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=8,
+            help='Maximum concurrent LLM requests (default: 8)'
+        )
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timedelta(days=options['days'])
+        users = list(User.objects.filter(is_active=True, last_login__gte=since))
+        self.stdout.write(f'Refreshing quick insights for {len(users)} users...')
+
+        results = asyncio.run(
+            get_advice_batch(users, concurrency=options['concurrency'], use_cache=True)
+        )
+
+        saved = sum(
+            save_quick_insights(user, result)
+            for user, result in zip(users, results)
+        )
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Quick insights refreshed: {saved}/{len(users)}')
+        )
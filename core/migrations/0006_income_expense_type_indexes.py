@@ -0,0 +1,23 @@
+# Generated by Django 5.0.14 on 2026-10-15 22:34
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_userprofile_bio'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['user', 'expense_type', 'date'], name='core_expens_user_id_3c8f22_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='income',
+            index=models.Index(fields=['user', 'income_type', 'date'], name='core_income_user_id_f65802_idx'),
+        ),
+    ]
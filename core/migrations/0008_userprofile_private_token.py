@@ -0,0 +1,18 @@
+# Generated by Django 5.0.14 on 2026-10-15 23:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_quickinsightcache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='private_token',
+            field=models.CharField(blank=True, help_text='Private login token (alternative to password)', max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.14 on 2026-10-15 23:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_userprofile_private_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='advice_snippets',
+            field=models.JSONField(blank=True, help_text='Advice snippets parsed at write time (used for duplicate checks)', null=True),
+        ),
+    ]
@@ -1,9 +1,17 @@
 from datetime import date
 from typing import Optional, Dict
 
+from django.db.models import Sum
+from django.db.models.functions import TruncMonth
+
 from core.utils.ai_utils import ai_predict_next_month
 
 
+def _monthly_totals(qs):
+    """Sum of amounts per month: rows {'month': date(Y, M, 1), 'total': Decimal}"""
+    return qs.annotate(month=TruncMonth('date')).values('month').annotate(total=Sum('amount')).order_by()
+
+
 def forecast_next_month_profit(incomes_qs, expenses_qs, user=None) -> Dict:
     """
     Returns a dict with 'next_month_profit', 'reasoning', and 'method'.
@@ -18,14 +26,12 @@ def forecast_next_month_profit(incomes_qs, expenses_qs, user=None) -> Dict:
                 'method': 'AI (LLM)'
             }
 
-    # Aggregate by month
+    # Aggregate by month in the database (one row per month instead of per transaction)
     by_month = {}
-    for o in incomes_qs:
-        key = o.date.replace(day=1)
-        by_month[key] = by_month.get(key, 0.0) + float(o.amount)
-    for o in expenses_qs:
-        key = o.date.replace(day=1)
-        by_month[key] = by_month.get(key, 0.0) - float(o.amount)
+    for row in _monthly_totals(incomes_qs):
+        by_month[row['month']] = by_month.get(row['month'], 0.0) + float(row['total'])
+    for row in _monthly_totals(expenses_qs):
+        by_month[row['month']] = by_month.get(row['month'], 0.0) - float(row['total'])
 
     if not by_month:
         return {'next_month_profit': 0.0, 'method': 'None', 'reasoning': 'Нет данных'}
@@ -37,15 +43,11 @@ def forecast_next_month_profit(incomes_qs, expenses_qs, user=None) -> Dict:
         return {'next_month_profit': profits[0] if profits else 0.0, 'method': 'Static', 'reasoning': 'Мало данных для анализа тренда.'}
 
     # Lazy import to save memory
-    from sklearn.linear_model import LinearRegression
     import numpy as np
 
-    X = np.array(range(len(months))).reshape(-1, 1)
-    y = np.array(profits)
-    model = LinearRegression()
-    model.fit(X, y)
-    next_idx = np.array([[len(months)]])
-    pred = float(model.predict(next_idx)[0])
+    # Single-feature least squares: np.polyfit instead of sklearn's LinearRegression
+    slope, intercept = np.polyfit(np.arange(len(months), dtype=np.float64), np.asarray(profits, dtype=np.float64), 1)
+    pred = float(slope * len(months) + intercept)
     
     return {
         'next_month_profit': round(pred, 2),
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
 import uuid
 from django.utils import timezone
 
@@ -37,6 +38,10 @@ class UserProfile(models.Model):
         ('ky', 'Кыргызча')
     ])
     demo_mode = models.BooleanField(default=False, help_text='Enable demo data for presentations')
+    private_token = models.CharField(
+        max_length=64, unique=True, null=True, blank=True,
+        help_text='Private login token (alternative to password)'
+    )
     
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
@@ -417,6 +422,8 @@ class Income(models.Model):
     class Meta:
         indexes = [
             models.Index(fields=['user', 'date']),
+            # Фильтр по категориям в контексте ИИ: user + тип + диапазон дат
+            models.Index(fields=['user', 'income_type', 'date']),
             models.Index(fields=['source_file']),
         ]
 
@@ -468,6 +475,8 @@ class Expense(models.Model):
     class Meta:
         indexes = [
             models.Index(fields=['user', 'date']),
+            # Фильтр по категориям в контексте ИИ: user + тип + диапазон дат
+            models.Index(fields=['user', 'expense_type', 'date']),
             models.Index(fields=['source_file']),
         ]
     
@@ -633,6 +642,10 @@ class ChatMessage(models.Model):
     encrypted_content = models.TextField(blank=True, null=True)
     is_encrypted = models.BooleanField(default=False)
     content_hash = models.CharField(max_length=64, db_index=True)
+    advice_snippets = models.JSONField(
+        null=True, blank=True,
+        help_text='Advice snippets parsed at write time (used for duplicate checks)'
+    )
     metadata = models.JSONField(default=dict, blank=True)
     is_useful = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -646,3 +659,13 @@ class ChatMessage(models.Model):
     
     def __str__(self) -> str:
         return f"{self.role}: {self.content[:50]}..."
+
+
+class QuickInsightCache(models.Model):
+    """Предрассчитанные инсайты дашборда "Что нового?" (обновляются ночью)"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='quick_insight_cache')
+    payload = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    generated_at = models.DateTimeField(default=timezone.now)
+    
+    def __str__(self) -> str:
+        return f"QuickInsightCache {self.user_id} ({self.generated_at:%Y-%m-%d %H:%M})"
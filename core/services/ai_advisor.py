@@ -8,6 +8,7 @@ from typing import Dict, List, Optional
 from datetime import date, timedelta
 from decimal import Decimal
 from django.contrib.auth.models import User
+from django.db.models import Q, Sum
 
 from core.ai_services.llm_manager import llm_manager
 from core.services.forecasting import ForecastingService
@@ -75,11 +76,15 @@ class AIAdvisorService:
         end_date = date.today()
         start_date = end_date - timedelta(days=30)
         
-        expenses = Expense.objects.filter(user=self.user, date__gte=start_date, date__lte=end_date)
-        
-        # Calculate patterns
-        total_expense = sum(e.amount for e in expenses)
-        essential_expense = sum(e.amount for e in expenses if e.is_essential)
+        # Calculate patterns (sums are computed by the database)
+        totals = Expense.objects.filter(
+            user=self.user, date__gte=start_date, date__lte=end_date
+        ).aggregate(
+            total=Sum('amount'),
+            essential=Sum('amount', filter=Q(is_essential=True)),
+        )
+        total_expense = totals['total'] or Decimal(0)
+        essential_expense = totals['essential'] or Decimal(0)
         non_essential = total_expense - essential_expense
         
         # Category breakdown
@@ -1,25 +1,29 @@
 """
-Сигналы Django для автоматического обновления финансовой памяти
-после создания/обновления/удаления транзакций.
+Сигналы Django для сброса пользовательских кэшей (AI-контекст, финансовая
+память, токены входа) после создания/обновления/удаления данных.
+Финансовая память пересчитывается лениво — при следующем обращении.
+Импорт файлов пишет через bulk_create без сигналов и сбрасывает версию сам
+(см. core/utils/file_ingest.py).
 """
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
-from .models import Income, Expense
-from .utils.analytics import update_user_financial_memory
+from .models import Income, Expense, UserProfile
+from .utils.cache import bump_data_version, forget_private_token
 
 
 @receiver(post_save, sender=Income)
 @receiver(post_save, sender=Expense)
 @receiver(post_delete, sender=Income)
 @receiver(post_delete, sender=Expense)
-def update_financial_memory_on_transaction_change(sender, instance, **kwargs):
-    """Обновляет финансовую память пользователя после изменения транзакций."""
-    if instance.user:
-        try:
-            # Обновляем память принудительно
-            update_user_financial_memory(instance.user, force_refresh=True)
-        except Exception:
-            # Игнорируем ошибки, чтобы не блокировать сохранение транзакции
-            pass
+def invalidate_user_cache_on_transaction_change(sender, instance, **kwargs):
+    """Сбрасывает кэшированный AI-контекст и финансовую память пользователя после изменения транзакций."""
+    if instance.user_id:
+        bump_data_version(instance.user_id)
 
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_private_token_cache(sender, instance, **kwargs):
+    """Сбрасывает кэш разрешения приватного токена при его смене/удалении профиля."""
+    forget_private_token(instance.user_id, instance.private_token)
@@ -0,0 +1,413 @@
+"""
+Test suite for the AI advisor module (query analysis and context building)
+Run with: python manage.py test core.tests_ai_advisor
+"""
+
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+import json
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest.mock import MagicMock, patch
+
+import requests
+
+from django.urls import reverse
+from django.utils import timezone
+
+from core.models import Income, Expense, QuickInsightCache, ChatMessage
+from core.ai.advisor import EnhancedFinancialAdvisor
+from core.ai.query_analyzer import QueryType, analyze_query
+from core.ai.keyword_matcher import KeywordMatcher
+from core.ai.context_builder import build_enriched_context
+from core.ai.response_cache import get_cached_response, store_response
+from core.utils.analytics import get_user_financial_memory
+from core.utils.file_ingest import _persist_transactions
+from core.llm import chat_with_context, stream_chat_with_context
+
+
+class QueryAnalyzerTests(TestCase):
+    """Test query type and category detection"""
+    
+    def test_detects_type_and_categories(self):
+        """Test that keywords and categories are found in one query"""
+        analysis = analyze_query('Покажи тренд и рост расходов: еда и транспорт')
+        self.assertEqual(analysis.query_type, QueryType.TRENDS)
+        self.assertEqual(analysis.categories, ['еда', 'транспорт'])
+    
+    def test_general_query_without_keywords(self):
+        """Test that unknown queries fall back to the general type"""
+        analysis = analyze_query('Hello there')
+        self.assertEqual(analysis.query_type, QueryType.GENERAL)
+        self.assertEqual(analysis.categories, [])
+    
+    def test_time_marker_matches_from_word_start(self):
+        """Test that time markers are not found inside other words"""
+        self.assertEqual(analyze_query('позавчера').time_period['days_ago'], 2)
+        self.assertEqual(analyze_query('выгодно ли копить').time_period['days_ago'], 90)
+    
+    def test_matcher_finds_overlapping_keywords(self):
+        """Test that overlapping and nested keywords are all reported"""
+        matcher = KeywordMatcher(['save', 'save up', 'he', 'she', 'hers'])
+        self.assertEqual(
+            matcher.find('ushers save up'),
+            {'save', 'save up', 'he', 'she', 'hers'}
+        )
+    
+    def test_longest_keyword_wins_on_overlap(self):
+        """Test that the most specific keyword is used for the query type"""
+        matcher = KeywordMatcher(['save', 'save up', 'he', 'she', 'hers'])
+        self.assertEqual(matcher.find_longest('ushers save up'), {'she', 'save up'})
+        self.assertEqual(analyze_query('how to save up for a bike').query_type, QueryType.GOALS)
+
+
+class ContextBuilderTests(TestCase):
+    """Test enriched context building"""
+    
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='advisor', password='password')
+        Income.objects.create(user=self.user, amount=Decimal('1000'), date=date.today(), income_type='salary')
+    
+    def test_context_is_cached_until_transactions_change(self):
+        """Test that context is reused and invalidated on new transactions"""
+        analysis = analyze_query('Give me advice')
+        first = build_enriched_context(self.user, analysis)
+        
+        Income.objects.filter(user=self.user).update(amount=Decimal('5000'))  # no signals
+        self.assertEqual(build_enriched_context(self.user, analysis), first)
+        
+        Expense.objects.create(user=self.user, amount=Decimal('200'), date=date.today(), expense_type='food')
+        self.assertNotEqual(build_enriched_context(self.user, analysis), first)
+    
+    def test_context_is_reset_by_file_import(self):
+        """Test that transactions imported with bulk_create invalidate the cached context"""
+        analysis = analyze_query('Give me advice')
+        first = build_enriched_context(self.user, analysis)
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            _persist_transactions(
+                [], [Expense(user=self.user, amount=Decimal('300'), date=date.today(), expense_type='food')]
+            )
+        
+        self.assertNotEqual(build_enriched_context(self.user, analysis), first)
+    
+    def test_russian_category_query_finds_its_transactions(self):
+        """Test that Russian category words are mapped to transaction type codes"""
+        Expense.objects.create(user=self.user, amount=Decimal('350'), date=date.today(), expense_type='food', description='Обед')
+        Expense.objects.create(user=self.user, amount=Decimal('900'), date=date.today(), expense_type='games', description='Игра')
+        
+        analysis = analyze_query('Сколько потратил на продукты в этом месяце?')
+        context = build_enriched_context(self.user, analysis)
+        
+        self.assertIn('Recent Transactions', context)
+        self.assertIn('Обед', context)
+        self.assertNotIn('Игра', context)
+    
+    def test_profile_section_is_reset_by_file_import(self):
+        """Test that the long-lived profile section picks up imported transactions"""
+        analysis = analyze_query('Give me advice')
+        self.assertIn('**Total Transactions:** 1', build_enriched_context(self.user, analysis))
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            _persist_transactions(
+                [Income(user=self.user, amount=Decimal('500'), date=date.today(), income_type='gift')], []
+            )
+        
+        self.assertIn('**Total Transactions:** 2', build_enriched_context(self.user, analysis))
+    
+    def test_financial_memory_is_cached_until_transactions_change(self):
+        """Test that financial memory is served from cache and recomputed after a change"""
+        memory = get_user_financial_memory(self.user)
+        
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_financial_memory(self.user), memory)
+        
+        Expense.objects.create(user=self.user, amount=Decimal('200'), date=date.today(), expense_type='food')
+        month = get_user_financial_memory(self.user)['months'][memory['ordered_keys'][0]]
+        self.assertEqual(month['expense_total'], 200.0)
+
+
+class ResponseCacheTests(TestCase):
+    """Test reuse of LLM responses for repeated questions"""
+    
+    def setUp(self):
+        cache.clear()
+    
+    def test_near_identical_query_hits_cache(self):
+        """Test that punctuation/case differences reuse the cached response"""
+        store_response(1, 'How much did I spend last month?', 'ctx', 'answer')
+        self.assertEqual(get_cached_response(1, 'how much did i spend last month', 'ctx'), 'answer')
+        self.assertIsNone(get_cached_response(1, 'how much did i spend last month', 'other ctx'))
+        self.assertIsNone(get_cached_response(2, 'how much did i spend last month', 'ctx'))
+    
+    def test_error_responses_are_not_cached(self):
+        """Test that LLM error messages are never stored"""
+        store_response(1, 'show trends', 'ctx', '[AI Error] timeout')
+        self.assertIsNone(get_cached_response(1, 'show trends', 'ctx'))
+
+
+class QuickInsightsTests(TestCase):
+    """Test serving dashboard insights from the nightly cache"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(username='insights', password='password')
+    
+    @patch('core.ai.advisor.chat_with_context')
+    def test_fresh_payload_is_served_without_llm(self, mock_chat):
+        """Test that a recent pre-generated payload skips the LLM call"""
+        QuickInsightCache.objects.create(user=self.user, payload={'response': 'stored'})
+        
+        result = EnhancedFinancialAdvisor(self.user).get_quick_insights()
+        
+        self.assertEqual(result, {'response': 'stored'})
+        mock_chat.assert_not_called()
+    
+    @patch('core.ai.advisor.chat_with_context', return_value='fresh insights')
+    def test_stale_payload_is_regenerated(self, mock_chat):
+        """Test that an outdated payload is replaced with a new response"""
+        QuickInsightCache.objects.create(
+            user=self.user,
+            payload={'response': 'old'},
+            generated_at=timezone.now() - timedelta(days=2)
+        )
+        
+        result = EnhancedFinancialAdvisor(self.user).get_quick_insights()
+        
+        self.assertEqual(result['response'], 'fresh insights')
+        self.assertEqual(
+            QuickInsightCache.objects.get(user=self.user).payload['response'],
+            'fresh insights'
+        )
+
+
+class ChatApiV2Tests(TestCase):
+    """Test the enhanced chat API endpoint"""
+    
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='chatter', password='password')
+        self.client.login(username='chatter', password='password')
+    
+    @patch('core.ai.advisor.chat_with_context', return_value='- Spend less on food')
+    def test_saves_question_and_answer(self, mock_chat):
+        """Test that the question and the reply are stored in order"""
+        response = self.client.post(
+            reverse('core:ai_chat_v2'),
+            data='{"message": "Give me advice"}',
+            content_type='application/json'
+        )
+        
+        data = response.json()
+        self.assertTrue(data['ok'])
+        self.assertEqual(data['reply'], '- Spend less on food')
+        self.assertEqual(
+            list(ChatMessage.objects.order_by('created_at', 'id').values_list('role', 'content')),
+            [('user', 'Give me advice'), ('assistant', '- Spend less on food')]
+        )
+        
+        # The current question is sent to the LLM only once
+        messages = mock_chat.call_args.kwargs['messages']
+        self.assertEqual([m['content'] for m in messages].count('Give me advice'), 1)
+    
+    @patch('core.ai.advisor.chat_with_context', return_value='- Spend less on food')
+    def test_form_stream_false_returns_json(self, mock_chat):
+        """Test that a form-encoded stream=0 flag is not treated as a stream request"""
+        response = self.client.post(reverse('core:ai_chat_v2'), {'message': 'Give me advice', 'stream': '0'})
+        
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertTrue(response.json()['ok'])
+    
+    @patch('core.ai.advisor.stream_chat_with_context', side_effect=lambda **kwargs: iter(['- Spend less ', 'on food']))
+    def test_stream_mode_emits_sse_events(self, mock_chat):
+        """Test that stream mode sends session, delta, reply and done events"""
+        response = self.client.post(
+            reverse('core:ai_chat_v2') + '?stream=1',
+            data='{"message": "Give me advice"}',
+            content_type='application/json'
+        )
+        
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = [
+            json.loads(frame[len('data: '):])
+            for frame in b''.join(response.streaming_content).decode().split('\n\n')
+            if frame
+        ]
+        self.assertEqual([event['type'] for event in events], ['session', 'delta', 'delta', 'reply', 'done'])
+        self.assertEqual(events[2]['content'], 'on food')
+        self.assertEqual(events[3]['content'], '- Spend less on food')
+        self.assertTrue(events[4]['ok'])
+        self.assertEqual(
+            ChatMessage.objects.get(role='assistant').content, '- Spend less on food'
+        )
+    
+    @override_settings(LLM_API_KEY='key', GOOGLE_API_KEY='', LLM_MODEL='openai/gpt-4o-mini')
+    @patch('core.ai.advisor.store_response')
+    @patch('core.llm._http.post')
+    def test_broken_stream_is_neither_cached_nor_saved(self, mock_post, mock_store):
+        """Test that a stream cut off mid-reply ends with an error event and stores nothing"""
+        def lines():
+            yield b'data: {"choices": [{"delta": {"content": "Your trends "}}]}'
+            raise requests.exceptions.ChunkedEncodingError('connection reset')
+        
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.__enter__.return_value = mock_post.return_value
+        mock_post.return_value.iter_lines.side_effect = lines
+        
+        events = self.stream_events('Show my spending trends')
+        
+        self.assertEqual([event['type'] for event in events], ['session', 'delta', 'error'])
+        self.assertFalse(events[2]['ok'])
+        mock_store.assert_not_called()
+        self.assertFalse(ChatMessage.objects.exists())
+    
+    @override_settings(LLM_API_KEY='key', GOOGLE_API_KEY='', LLM_MODEL='openai/gpt-4o-mini')
+    @patch('core.ai.advisor.store_response')
+    @patch('core.llm._http.post')
+    def test_in_band_stream_error_is_not_saved(self, mock_post, mock_store):
+        """Test that an error frame sent with HTTP 200 ends with an error event, not an empty reply"""
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.__enter__.return_value = mock_post.return_value
+        mock_post.return_value.iter_lines.return_value = iter([
+            b'data: {"error": {"message": "Provider returned error", "code": 502}}',
+            b'data: [DONE]',
+        ])
+        
+        events = self.stream_events('Show my spending trends')
+        
+        self.assertEqual([event['type'] for event in events], ['session', 'error'])
+        self.assertIn('Provider returned error', events[1]['error'])
+        mock_store.assert_not_called()
+        self.assertFalse(ChatMessage.objects.exists())
+    
+    def stream_events(self, message):
+        response = self.client.post(
+            reverse('core:ai_chat_v2') + '?stream=1',
+            data=json.dumps({'message': message}),
+            content_type='application/json'
+        )
+        return [
+            json.loads(frame[len('data: '):])
+            for frame in b''.join(response.streaming_content).decode().split('\n\n')
+            if frame
+        ]
+    
+    @override_settings(LLM_API_KEY='key', GOOGLE_API_KEY='', LLM_MODEL='openai/gpt-4o-mini')
+    @patch('core.llm._http.post')
+    def test_llm_stream_yields_content_deltas(self, mock_post):
+        """Test that SSE chunks from the LLM API are yielded as text deltas"""
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.__enter__.return_value = mock_post.return_value
+        mock_post.return_value.iter_lines.return_value = iter([
+            b': OPENROUTER PROCESSING',
+            b'data: {"choices": [{"delta": {"content": "Save "}}]}',
+            b'',
+            b'data: {"choices": [{"delta": {"content": "more"}}]}',
+            b'data: [DONE]',
+        ])
+        
+        chunks = list(stream_chat_with_context([{'role': 'user', 'content': 'Hi'}], check_duplicates=False))
+        
+        self.assertEqual(chunks, ['Save ', 'more'])
+        self.assertTrue(json.loads(mock_post.call_args.kwargs['data'])['stream'])
+    
+    @override_settings(LLM_API_KEY='key', GOOGLE_API_KEY='', LLM_MODEL='primary:free')
+    @patch('core.llm._http.post')
+    def test_fallback_model_is_queried_alongside_primary(self, mock_post):
+        """Test that the first fallback model answers when the primary is over quota"""
+        cache.clear()
+        
+        def post(url, headers, data, timeout):
+            response = MagicMock()
+            if json.loads(data)['model'] == 'primary:free':
+                response.status_code = 429
+                response.content = b'{"error": {"message": "quota exceeded"}}'
+            else:
+                response.status_code = 200
+                response.content = b'{"choices": [{"message": {"content": "Fallback advice"}}]}'
+            return response
+        mock_post.side_effect = post
+        
+        reply = chat_with_context([{'role': 'user', 'content': 'Hi'}], check_duplicates=False, anonymize=False)
+        
+        self.assertEqual(reply, 'Fallback advice')
+        self.assertEqual(mock_post.call_count, 2)
+
+
+class WowFeaturesTests(TestCase):
+    """Test the confidence and health score endpoints"""
+    
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='health', password='password')
+        self.client.login(username='health', password='password')
+    
+    def test_health_score_from_aggregates(self):
+        """Test that the health score components are computed from DB aggregates"""
+        today = date.today()
+        for amount, income_type in ((1000, 'salary'), (1000, 'salary'), (500, 'gift')):
+            Income.objects.create(user=self.user, amount=Decimal(amount), date=today, income_type=income_type)
+        for amount, expense_type in ((300, 'food'), (200, 'transport')):
+            Expense.objects.create(user=self.user, amount=Decimal(amount), date=today, expense_type=expense_type)
+        
+        data = self.client.get(reverse('core:health_score')).json()
+        
+        self.assertEqual(data['score'], 70)
+        self.assertEqual(data['grade'], 'B')
+        self.assertEqual(data['components']['savings_rate']['value'], '80.0%')
+        self.assertEqual(data['components']['income_stability']['score'], 15)
+        self.assertEqual(data['components']['diversification']['score'], 10)
+        self.assertEqual(data['components']['expense_control']['score'], 10)
+    
+    def test_health_score_cache_is_reset_by_new_transaction(self):
+        """Test that a cached health score is recomputed after a transaction change"""
+        Income.objects.create(user=self.user, amount=Decimal('1000'), date=date.today())
+        url = reverse('core:health_score')
+        self.assertEqual(self.client.get(url).json()['components']['savings_rate']['value'], '100.0%')
+        
+        # Only the session and user lookups; the score comes from the cache
+        with self.assertNumQueries(2):
+            self.client.get(url)
+        
+        Expense.objects.create(user=self.user, amount=Decimal('500'), date=date.today())
+        self.assertEqual(self.client.get(url).json()['components']['savings_rate']['value'], '50.0%')
+        
+        # File imports insert with bulk_create (no post_save) and must reset it too
+        with self.captureOnCommitCallbacks(execute=True):
+            _persist_transactions([], [Expense(user=self.user, amount=Decimal('250'), date=date.today())])
+        self.assertEqual(self.client.get(url).json()['components']['savings_rate']['value'], '25.0%')
+    
+    def test_confidence_uses_oldest_expense(self):
+        """Test that history length comes from the oldest expense date"""
+        Expense.objects.create(user=self.user, amount=Decimal('100'), date=date.today() - timedelta(days=100))
+        Expense.objects.create(user=self.user, amount=Decimal('50'), date=date.today())
+        
+        data = self.client.post(
+            reverse('core:ai_confidence'),
+            data=json.dumps({'message': 'Где сэкономить на еда?'}),
+            content_type='application/json'
+        ).json()
+        
+        self.assertEqual(data['details']['transactions'], 2)
+        self.assertEqual(data['details']['days_history'], 100)
+        self.assertEqual(data['confidence'], 75)
+    
+    @patch('core.ai.wow_features.get_financial_advice')
+    def test_streaming_sends_thinking_then_content(self, mock_advice):
+        """Test that the stream emits thinking frames and 5-word content chunks"""
+        mock_advice.return_value = {'response': 'one two three four five six', 'query_type': 'general'}
+        
+        response = self.client.post(
+            reverse('core:ai_chat_streaming'),
+            data=json.dumps({'message': 'Анализируй'}),
+            content_type='application/json'
+        )
+        events = [
+            json.loads(frame[len('data: '):])
+            for frame in b''.join(response.streaming_content).decode().split('\n\n') if frame
+        ]
+        
+        self.assertEqual([e['type'] for e in events], ['thinking'] * 3 + ['content', 'content', 'done'])
+        self.assertEqual(events[3]['message'], 'one two three four five ')
+        self.assertEqual(events[4]['message'], 'six ')
@@ -0,0 +1,59 @@
+"""
+Test suite for the login form (password and private token)
+Run with: python manage.py test core.tests_auth
+"""
+
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.urls import reverse
+
+from core.models import UserProfile
+
+
+class PrivateTokenLoginTests(TestCase):
+    """Test logging in with a private token instead of a password"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='teen', password='password')
+        UserProfile.objects.create(user=self.user, private_token='secret-token')
+
+    def login_with_token(self, token):
+        return self.client.post(reverse('core:login'), {'username': 'teen', 'private_token': token})
+
+    def test_token_logs_user_in(self):
+        """Test that a valid token logs the user in without a password"""
+        response = self.login_with_token('secret-token')
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(int(self.client.session['_auth_user_id']), self.user.pk)
+
+    def test_rotated_token_is_rejected(self):
+        """Test that the cached token resolution is dropped when the token changes"""
+        self.login_with_token('secret-token')
+        self.client.logout()
+
+        profile = self.user.teen_profile
+        profile.private_token = 'new-token'
+        profile.save()
+
+        self.assertEqual(self.login_with_token('secret-token').status_code, 200)
+        self.assertNotIn('_auth_user_id', self.client.session)
+        self.assertEqual(self.login_with_token('new-token').status_code, 302)
+
+    def test_token_wins_over_wrong_password(self):
+        """Test that a valid token logs in even if a wrong password is also sent"""
+        response = self.client.post(
+            reverse('core:login'),
+            {'username': 'teen', 'password': 'wrong', 'private_token': 'secret-token'}
+        )
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_password_login_still_works(self):
+        """Test that the regular username/password login is unchanged"""
+        response = self.client.post(reverse('core:login'), {'username': 'teen', 'password': 'password'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(int(self.client.session['_auth_user_id']), self.user.pk)
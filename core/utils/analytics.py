@@ -5,13 +5,20 @@ import re
 import statistics
 from collections import defaultdict
 from datetime import date
+from functools import lru_cache
 from typing import Dict, List, Tuple, Any
 
+from django.core.cache import cache
 from django.utils import timezone
 
 from core.models import Income, Expense, UserProfile
+from core.utils.cache import user_cache_key
 
 
+# Память пересчитывается заново после смены версии данных пользователя
+# (core/signals.py); таймаут лишь ограничивает срок жизни записи
+FINANCIAL_MEMORY_CACHE_TIMEOUT = 600
+
 MONTH_LABELS = {
     1: ("январь", "январе"),
     2: ("февраль", "феврале"),
@@ -32,17 +39,23 @@ def _month_key(dt: date) -> str:
     return f"{dt.year:04d}-{dt.month:02d}"
 
 
+@lru_cache(maxsize=4096)
+def _format_rounded(rounded: float) -> str:
+    # + 0.0 превращает -0.0 в 0.0, чтобы не выводить "-0"
+    text = f"{rounded + 0.0:,.2f}".replace(",", " ")
+    if text.endswith("00"):
+        return text[:-3]
+    if text.endswith("0"):
+        return text[:-1]
+    return text
+
+
 def _format_currency(value: float) -> str:
+    # Суммы в таблицах и трендах повторяются от запроса к запросу,
+    # поэтому строка кэшируется по уже округлённому значению.
     if value is None:
         return "0"
-    rounded = round(float(value), 2)
-    integer_part, dot, fractional = f"{abs(rounded):,.2f}".partition(".")
-    integer_part = integer_part.replace(",", " ")
-    fractional = fractional.rstrip("0")
-    sign = "-" if rounded < 0 else ""
-    if fractional:
-        return f"{sign}{integer_part}.{fractional}"
-    return f"{sign}{integer_part}"
+    return _format_rounded(round(float(value), 2))
 
 
 def _compute_pct_change(current: float, previous: float) -> float | None:
@@ -362,7 +375,7 @@ def compute_financial_memory(user) -> Dict[str, Any]:
     return {
         'generated_at': timezone.now().isoformat(),
         'ordered_keys': ordered_keys,
-        'months': months,
+        'months': dict(months),  # defaultdict с lambda не сериализуется в кэш
         'table_markdown': table_md,
         'summary_text': summary_text,
         'trends': trends,  # Новое: анализ трендов
@@ -381,14 +394,31 @@ def compute_financial_memory(user) -> Dict[str, Any]:
 
 
 def update_user_financial_memory(user, force_refresh: bool = False) -> Dict[str, Any]:
-    # Since UserProfile no longer has financial_memory, we just compute it.
-    # If we need persistence, we should add the field back or use a different model.
-    # For now, on-the-fly computation.
-    return compute_financial_memory(user)
+    """Пересчитывает финансовую память и кладет ее в кэш"""
+    key = user_cache_key('financial_memory', user.pk)
+    memory = compute_financial_memory(user)
+    cache.set(key, memory, FINANCIAL_MEMORY_CACHE_TIMEOUT)
+    user._financial_memory = (key, memory)
+    return memory
 
 
 def get_user_financial_memory(user, force_refresh: bool = False) -> Dict[str, Any]:
-    return compute_financial_memory(user)
+    """
+    Возвращает финансовую память из кэша; пересчитывает ее, если данные
+    пользователя изменились (ключ версионный) или запрошен force_refresh.
+    В пределах запроса память запоминается на объекте user: контекст советника
+    и промпт LLM не читают и не распаковывают ее из кэша повторно.
+    """
+    if not force_refresh:
+        key = user_cache_key('financial_memory', user.pk)
+        local = getattr(user, '_financial_memory', None)
+        if local is not None and local[0] == key:
+            return local[1]
+        memory = cache.get(key)
+        if memory is not None:
+            user._financial_memory = (key, memory)
+            return memory
+    return update_user_financial_memory(user)
 
 
 PROMPT_INSTRUCTION_BLOCK = """
@@ -509,6 +539,25 @@ def build_system_prompt(memory: Dict[str, Any], extra_context: str = "") -> str:
     return prompt
 
 
+_NUMBERED_ITEM_RE = re.compile(r'\d+\.')
+
+# Приоритеты советов по эмодзи (порядок важен: берется первое совпадение)
+_PRIORITY_BY_EMOJI = {
+    '🚨': 'urgent',
+    '⚡': 'quick_win',
+    '📅': 'long_term',
+    '✅': 'actionable',
+    '🔥': 'now',
+    '📆': 'this_month',
+    '🔮': 'future',
+}
+_NOW_KEYWORDS = ('сейчас', 'now', 'сегодня')
+_MONTH_KEYWORDS = ('месяц', 'month', 'этом')
+_FUTURE_KEYWORDS = ('будущее', 'future', 'будущем')
+# Заголовки блоков ответа, на которых заканчивается текущий совет
+_BLOCK_MARKERS = ('##', '###', '🚦', '🚩', '🛠', '📈', '📊', '🤝')
+
+
 def parse_actionable_items(reply: str) -> List[Dict[str, Any]]:
     """Извлекает actionable советы из ответа AI с поддержкой новых тегов."""
     items: List[Dict[str, Any]] = []
@@ -516,47 +565,36 @@ def parse_actionable_items(reply: str) -> List[Dict[str, Any]]:
     current_item = None
     current_section = None  # 🔥 СЕЙЧАС, 📆 ЭТОТ МЕСЯЦ, 🔮 БУДУЩЕЕ
     
-    # Определяем приоритеты по эмодзи и ключевым словам
-    priority_map = {
-        '🚨': 'urgent',
-        '⚡': 'quick_win',
-        '📅': 'long_term',
-        '✅': 'actionable',
-        '🔥': 'now',
-        '📆': 'this_month',
-        '🔮': 'future',
-    }
-    
     for line in lines:
         stripped = line.strip()
         if not stripped:
             continue
         
         # Определяем секцию по заголовкам
-        if '🔥' in stripped and any(keyword in stripped.lower() for keyword in ['сейчас', 'now', 'сегодня']):
+        if '🔥' in stripped and any(keyword in stripped.lower() for keyword in _NOW_KEYWORDS):
             current_section = 'now'
             continue
-        elif '📆' in stripped and any(keyword in stripped.lower() for keyword in ['месяц', 'month', 'этом']):
+        elif '📆' in stripped and any(keyword in stripped.lower() for keyword in _MONTH_KEYWORDS):
             current_section = 'this_month'
             continue
-        elif '🔮' in stripped and any(keyword in stripped.lower() for keyword in ['будущее', 'future', 'будущем']):
+        elif '🔮' in stripped and any(keyword in stripped.lower() for keyword in _FUTURE_KEYWORDS):
             current_section = 'future'
             continue
         elif '🚨' in stripped or '⚡' in stripped or '📅' in stripped or '✅' in stripped:
             # Определяем приоритет по эмодзи
-            for emoji, priority in priority_map.items():
+            for emoji, priority in _PRIORITY_BY_EMOJI.items():
                 if emoji in stripped:
                     current_section = priority
                     break
             continue
         
         # Нумерованные списки (1., 2., 3., etc.)
-        if re.match(r'^\d+\.', stripped):
+        if _NUMBERED_ITEM_RE.match(stripped):
             if current_item:
                 items.append(current_item)
             
             priority = None
-            for emoji, p in priority_map.items():
+            for emoji, p in _PRIORITY_BY_EMOJI.items():
                 if emoji in stripped:
                     priority = p
                     break
@@ -573,7 +611,7 @@ def parse_actionable_items(reply: str) -> List[Dict[str, Any]]:
                 items.append(current_item)
             
             priority = None
-            for emoji, p in priority_map.items():
+            for emoji, p in _PRIORITY_BY_EMOJI.items():
                 if emoji in stripped:
                     priority = p
                     break
@@ -585,7 +623,7 @@ def parse_actionable_items(reply: str) -> List[Dict[str, Any]]:
                 'priority': priority or 'normal',
             }
         # Продолжение текущего совета
-        elif current_item and not any(marker in stripped for marker in ['##', '###', '🚦', '🚩', '🛠', '📈', '📊', '🤝']):
+        elif current_item and not any(marker in stripped for marker in _BLOCK_MARKERS):
             if len(stripped) > 10 and not stripped.startswith('|'):
                 current_item['text'] += ' ' + stripped
         else:
@@ -602,7 +640,7 @@ def parse_actionable_items(reply: str) -> List[Dict[str, Any]]:
 
 def detect_anomalies_automatically(user) -> List[Dict[str, Any]]:
     """Автоматически обнаруживает аномалии после загрузки данных и возвращает список оповещений с форматом ALERT."""
-    memory = compute_financial_memory(user)
+    memory = get_user_financial_memory(user)
     alerts = memory.get('alerts', [])
     
     # Дополнительная проверка на резкие изменения
@@ -32,6 +32,11 @@ PATTERNS = {
 }
 
 
+# Номерам (счета, карты, телефоны, ИНН, СНИЛС) нужна хотя бы одна цифра, email — '@'.
+# Замены не добавляют ни того, ни другого, поэтому проверки делаются один раз
+_DIGIT_RE = re.compile(r'\d')
+
+
 def anonymize_text(text: str) -> str:
     """
     Анонимизирует текст, удаляя персональные данные.
@@ -46,30 +51,34 @@ def anonymize_text(text: str) -> str:
         return text
     
     result = text
+    has_digits = _DIGIT_RE.search(text) is not None
     
     # Заменяем ФИО на [ФИО]
     result = PATTERNS['fio'].sub('[ФИО]', result)
     
-    # Заменяем номера счетов на [НОМЕР_СЧЕТА]
-    result = PATTERNS['account'].sub('[НОМЕР_СЧЕТА]', result)
-    
-    # Заменяем номера карт на [НОМЕР_КАРТЫ]
-    result = PATTERNS['card'].sub('[НОМЕР_КАРТЫ]', result)
-    
-    # Заменяем телефоны на [ТЕЛЕФОН]
-    result = PATTERNS['phone'].sub('[ТЕЛЕФОН]', result)
+    if has_digits:
+        # Заменяем номера счетов на [НОМЕР_СЧЕТА]
+        result = PATTERNS['account'].sub('[НОМЕР_СЧЕТА]', result)
+        
+        # Заменяем номера карт на [НОМЕР_КАРТЫ]
+        result = PATTERNS['card'].sub('[НОМЕР_КАРТЫ]', result)
+        
+        # Заменяем телефоны на [ТЕЛЕФОН]
+        result = PATTERNS['phone'].sub('[ТЕЛЕФОН]', result)
     
     # Заменяем email на [EMAIL]
-    result = PATTERNS['email'].sub('[EMAIL]', result)
+    if '@' in result:
+        result = PATTERNS['email'].sub('[EMAIL]', result)
     
     # Заменяем адреса на [АДРЕС]
     result = PATTERNS['address'].sub('[АДРЕС]', result)
     
-    # Заменяем ИНН на [ИНН]
-    result = PATTERNS['inn'].sub('[ИНН]', result)
-    
-    # Заменяем СНИЛС на [СНИЛС]
-    result = PATTERNS['snils'].sub('[СНИЛС]', result)
+    if has_digits:
+        # Заменяем ИНН на [ИНН]
+        result = PATTERNS['inn'].sub('[ИНН]', result)
+        
+        # Заменяем СНИЛС на [СНИЛС]
+        result = PATTERNS['snils'].sub('[СНИЛС]', result)
     
     return result
 
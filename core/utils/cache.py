@@ -0,0 +1,70 @@
+"""
+Кэширование пользовательских данных с версионной инвалидацией.
+
+Каждый ключ включает номер версии данных пользователя. При изменении
+транзакций версия увеличивается (см. core/signals.py), и все старые ключи
+перестают использоваться — без удаления по шаблону, которое поддерживает
+не каждый бэкенд кэша.
+"""
+
+import hashlib
+
+from django.core.cache import cache
+
+
+def _version_key(user_id) -> str:
+    return f"user_data_ver:{user_id}"
+
+
+def get_data_version(user_id) -> int:
+    """Возвращает текущую версию финансовых данных пользователя"""
+    return cache.get(_version_key(user_id), 0)
+
+
+def bump_data_version(user_id) -> None:
+    """Инвалидирует все кэши пользователя, увеличивая версию данных"""
+    key = _version_key(user_id)
+    # add() не перезапишет существующее значение; incr() атомарен в Redis
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, timeout=None)
+
+
+def make_signature(*parts) -> str:
+    """Стабильный (между процессами) короткий хеш для части ключа"""
+    raw = repr(parts).encode('utf-8')
+    return hashlib.blake2b(raw, digest_size=8).hexdigest()
+
+
+def user_cache_key(prefix: str, user_id, *parts) -> str:
+    """Формирует ключ кэша вида prefix:user_id:vN[:signature]"""
+    key = f"{prefix}:{user_id}:v{get_data_version(user_id)}"
+    if parts:
+        key += f":{make_signature(*parts)}"
+    return key
+
+
+PRIVATE_TOKEN_CACHE_TIMEOUT = 60
+
+
+def private_token_key(token: str) -> str:
+    """Ключ кэша для токен -> user_id (сам токен в ключ не попадает)"""
+    return f"private_token:{hashlib.sha256(token.encode('utf-8')).hexdigest()}"
+
+
+def private_token_owner_key(user_id) -> str:
+    """Ключ, под которым хранится последний закэшированный токен пользователя"""
+    return f"private_token_owner:{user_id}"
+
+
+def forget_private_token(user_id, token=None) -> None:
+    """Сбрасывает закэшированное разрешение токена пользователя (старого и нового)"""
+    keys = [private_token_owner_key(user_id)]
+    old_key = cache.get(keys[0])
+    if old_key:
+        keys.append(old_key)
+    if token:
+        keys.append(private_token_key(token))
+    cache.delete_many(keys)
@@ -0,0 +1,48 @@
+"""
+Быстрая (де)сериализация JSON для горячих API.
+Использует orjson, если он установлен, иначе — стандартный json.
+"""
+
+import json
+from typing import Any
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Ошибка разбора JSON в обоих режимах (orjson.JSONDecodeError — подкласс ValueError,
+# как и json.JSONDecodeError и UnicodeDecodeError для битых байтов)
+JSONDecodeError = ValueError
+
+_django_encoder = DjangoJSONEncoder()
+
+
+def loads(data: Any) -> Any:
+    """Разбирает JSON из str или bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Сериализует объект в JSON (UTF-8 bytes).
+    Типы, которые не знает orjson (Decimal, lazy-строки и т.п.),
+    кодируются так же, как в DjangoJSONEncoder.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_django_encoder.default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, cls=DjangoJSONEncoder, ensure_ascii=False).encode('utf-8')
+
+
+class FastJsonResponse(HttpResponse):
+    """Аналог JsonResponse, сериализующий данные через dumps()"""
+
+    def __init__(self, data: Any, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=dumps(data), **kwargs)
@@ -2,6 +2,7 @@ import io
 import re
 import time
 import json
+from functools import partial
 from typing import List, Tuple, Optional, Dict, Set
 from datetime import date
 
@@ -10,6 +11,7 @@ from django.db import transaction
 from django.db.utils import OperationalError
 
 from core.models import Income, Expense, Document, UploadedFile
+from core.utils.cache import bump_data_version
 from core.llm import chat_with_context
 from core.utils.ai_utils import ai_categorize_batch
 
@@ -83,6 +85,7 @@ DB_LOCK_RETRY_DELAY = 0.2
 
 
 def _persist_transactions(income_objs: List[Income], expense_objs: List[Expense]) -> None:
+    user_ids = {obj.user_id for obj in (*income_objs, *expense_objs)}
     for attempt in range(DB_LOCK_RETRY_ATTEMPTS):
         try:
             with transaction.atomic():
@@ -90,6 +93,9 @@ def _persist_transactions(income_objs: List[Income], expense_objs: List[Expense]
                     Income.objects.bulk_create(income_objs, batch_size=200)
                 if expense_objs:
                     Expense.objects.bulk_create(expense_objs, batch_size=200)
+                # bulk_create не шлет post_save — сбрасываем кэши пользователей сами
+                for user_id in user_ids:
+                    transaction.on_commit(partial(bump_data_version, user_id))
             return
         except OperationalError as exc:
             if "locked" in str(exc).lower() and attempt < DB_LOCK_RETRY_ATTEMPTS - 1:
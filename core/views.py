@@ -1,6 +1,7 @@
 from datetime import date, timedelta
 import io
 import base64
+import secrets
 import uuid
 import json
 from typing import Dict, List, Any
@@ -15,7 +16,7 @@ from django.utils import timezone
 from django.http import HttpResponse, JsonResponse, FileResponse
 from django.contrib import messages
 from django.conf import settings
-from django.contrib.auth import login, authenticate, logout
+from django.contrib.auth import login, logout
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render, redirect
 from django.urls import reverse_lazy
@@ -170,7 +171,7 @@ from .utils.file_ingest import (
     find_duplicates,
 )
 from .utils.export import export_chat_to_csv, export_chat_to_docx, export_chat_to_pdf
-from .llm import get_ai_advice_from_data, chat_with_context, _compute_content_hash
+from .llm import get_ai_advice_from_data, chat_with_context, _compute_content_hash, _extract_advice_snippets
 from .utils.analytics import (
     update_user_financial_memory,
     get_user_financial_memory,
@@ -1114,12 +1115,12 @@ def ai_chat_api(request):
         session_memory_block = ""
     
     # Получаем историю диалога для контекста
-    history_messages = []
-    for prev_msg in ChatMessage.objects.filter(session=session).exclude(id=user_msg.id).order_by('created_at'):
-        history_messages.append({
-            'role': prev_msg.role,
-            'content': prev_msg.content
-        })
+    history_messages = list(
+        ChatMessage.objects.filter(session=session)
+        .exclude(id=user_msg.id)
+        .order_by('created_at')
+        .values('role', 'content')
+    )
     
     # Добавляем текущее сообщение
     history_messages.append({'role': 'user', 'content': msg})
@@ -1131,7 +1132,7 @@ def ai_chat_api(request):
         
         # Анализируем запрос
         query_analysis = analyze_query(msg)
-        query_type = query_analysis.get('query_type', 'general')
+        query_type = query_analysis.query_type
         
         # Получаем улучшенный ответ
         ai_result = get_financial_advice(
@@ -1209,6 +1210,7 @@ def ai_chat_api(request):
         role='assistant',
         content=reply,
         content_hash=_compute_content_hash(reply),
+        advice_snippets=_extract_advice_snippets(reply),
         metadata={
             'actionable_items': actionable_items,
             'items_count': len(actionable_items),
@@ -1231,7 +1233,7 @@ def ai_chat_api(request):
             action_log['all_advices'] = []
         
         for item in actionable_items:
-            advice_id = str(uuid.uuid4())[:8]
+            advice_id = secrets.token_hex(4)
             action_log['all_advices'].append({
                 'id': advice_id,
                 'text': item.get('text', ''),
@@ -1750,9 +1752,8 @@ def login_view(request):
     if request.method == 'POST':
         form = CustomAuthenticationForm(request, data=request.POST)
         if form.is_valid():
-            username = form.cleaned_data.get('username')
-            password = form.cleaned_data.get('password')
-            user = authenticate(request, username=username, password=password)
+            # Форма уже аутентифицировала пользователя (по паролю или токену)
+            user = form.get_user()
             if user is not None:
                 login(request, user)
                 messages.success(request, f'Добро пожаловать, {user.username}!')
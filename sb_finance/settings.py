@@ -68,6 +68,20 @@ if os.getenv('DATABASE_URL'):
         conn_health_checks=True,
     )
 
+# Кэш: Redis в продакшене (REDIS_URL), локальная память для разработки
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'sb-finance',
+    }
+}
+
+if os.getenv('REDIS_URL'):
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('REDIS_URL'),
+    }
+
 
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
@@ -221,6 +235,8 @@ LLM_API_KEY = os.getenv('LLM_API_KEY')
 LLM_MODEL = os.getenv('LLM_MODEL', 'openai/gpt-4o-mini')
 LLM_API_URL = os.getenv('LLM_API_URL', 'https://openrouter.ai/api/v1/chat/completions')
 LLM_HTTP_REFERER = os.getenv('LLM_HTTP_REFERER', 'http://localhost:8000')
+# Максимум одновременных запросов к провайдеру из одного процесса
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', '8'))
 
 # Teen-specific features
 TEEN_EDUCATION_ENABLED = True
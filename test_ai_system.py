@@ -46,10 +46,10 @@ def test_query_analyzer():
     for query in test_queries:
         print(f"\n📝 Запрос: {query}")
         result = analyze_query(query)
-        print(f"   Тип: {result['query_type']}")
-        print(f"   Категории: {result['categories']}")
-        print(f"   Период: {result['time_period']['type']}")
-        print(f"   Приоритет данных: {result['context_priority']}")
+        print(f"   Тип: {result.query_type}")
+        print(f"   Категории: {result.categories}")
+        print(f"   Период: {result.time_period['type']}")
+        print(f"   Приоритет данных: {result.context_priority}")
 
 
 def test_context_builder(user):